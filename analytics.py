@@ -0,0 +1,250 @@
+#!/usr/bin/python3
+import io
+import sys
+import gzip
+import json
+import html
+import time
+import argparse
+import itertools
+from csvtable import CsvStream, ColumnTable
+from tests import VOLTAGE_NAMES
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Yield, failures and rail voltages over the test history, as exported with 'db.py export tests <file>'.
+# Everything is computed on NumPy columns, so hundreds of thousands of runs take seconds.
+
+OUTLIER_Z = 3.5 # Robust z-score beyond which a value is an outlier
+
+def load_table(filename, fields = None):
+    """Reads a CSV or JSON lines (optionally .gz) export into a ColumnTable."""
+    if filename.endswith('.jsonl') or filename.endswith('.jsonl.gz'):
+        loads = orjson.loads if orjson else json.loads
+        opener = gzip.open if filename.endswith('.gz') else open
+        with opener(filename, 'rb') as f:
+            rows = (loads(line) for line in f if line.strip())
+            first = next(rows, { })
+            return ColumnTable(fields or list(first), itertools.chain([ first ], rows) if first else [ ])
+    stream = CsvStream(filename)
+    return ColumnTable(fields or stream.columns, stream)
+
+def to_float(values):
+    """Voltages are stored as strings; anything that is not a number becomes NaN."""
+    import numpy as np
+    def convert(v):
+        try:
+            return float(v)
+        except (TypeError, ValueError):
+            return np.nan
+    return np.fromiter((convert(v) for v in values), dtype = float, count = len(values))
+
+def to_bool(values):
+    import numpy as np
+    return np.fromiter((v is True or str(v).lower() in ('true', 'yes', '1') for v in values), dtype = bool, count = len(values))
+
+def to_str(values):
+    import numpy as np
+    return np.array([ '' if v is None else str(v) for v in values ], dtype = str)
+
+class History:
+    """The test runs as NumPy columns, sorted by board and date."""
+    def __init__(self, table, boards = None):
+        import numpy as np
+        self.np = np
+        serial = to_str(table.column('serial'))
+        date = to_str(table.column('date'))
+        order = np.lexsort((date, serial))
+        self.serial = serial[order]
+        self.date = date[order]
+        self.day = self.date.astype('U10')
+        self.git = to_str(table.column('git'))[order].astype('U9')
+        self.failed = to_str(table.column('failed'))[order]
+        self.critical = to_bool(table.column('critical'))[order]
+        self.flashed = to_bool(table.column('flashed'))[order]
+        self.booted = to_bool(table.column('booted'))[order]
+        self.passed = self.flashed & self.booted & ~self.critical & (self.failed == '')
+        self.rails = { rail: to_float(table.column(rail))[order] for rail in VOLTAGE_NAMES if rail in table.columns }
+        # The first run of every board; the history is sorted, so it is where the serial changes
+        self.first = np.ones(len(self.serial), dtype = bool)
+        self.first[1:] = self.serial[1:] != self.serial[:-1]
+        self.revision = self.lookup_revision(boards) if boards else None
+
+    def __len__(self):
+        return len(self.serial)
+
+    def lookup_revision(self, boards):
+        np = self.np
+        known = dict(zip(boards.column('serial'), boards.column('board_rev')))
+        return np.array([ str(known.get(s, '?')) for s in self.serial ], dtype = str)
+
+    def yield_by(self, keys):
+        """First pass yield per key, over the first run of each board: [ (key, boards, passed, yield) ]."""
+        np = self.np
+        keys = keys[self.first]
+        passed = self.passed[self.first]
+        (names, inverse) = np.unique(keys, return_inverse = True)
+        boards = np.bincount(inverse, minlength = len(names))
+        good = np.bincount(inverse, weights = passed, minlength = len(names)).astype(int)
+        return [ (str(n), int(b), int(g), g / b) for (n, b, g) in zip(names, boards, good) ]
+
+    def pareto(self, first_only = False):
+        """Failures per test number, most frequent first: [ (test, count, cumulative fraction) ]."""
+        np = self.np
+        failed = self.failed[self.first] if first_only else self.failed
+        critical = self.critical[self.first] if first_only else self.critical
+        joined = ','.join(f for f in failed if f)
+        tests = np.array(joined.split(',') if joined else [ ], dtype = str)
+        (names, counts) = np.unique(tests, return_counts = True)
+        names = list(names) + [ 'critical' ]
+        counts = np.append(counts, critical.sum())
+        order = np.argsort(-counts, kind = 'stable')
+        order = order[counts[order] > 0]
+        cumulative = np.cumsum(counts[order]) / max(counts.sum(), 1)
+        return [ (str(names[i]), int(counts[i]), float(c)) for (i, c) in zip(order, cumulative) ]
+
+    def rail_stats(self):
+        """Distribution per rail, and the runs whose value is an outlier by robust z-score (median / MAD)."""
+        np = self.np
+        result = [ ]
+        for (rail, values) in self.rails.items():
+            valid = ~np.isnan(values)
+            v = values[valid]
+            if not len(v):
+                continue
+            median = np.median(v)
+            mad = np.median(np.abs(v - median))
+            z = np.zeros(len(values))
+            if mad > 0:
+                z[valid] = 0.6745 * (v - median) / mad
+            outliers = np.flatnonzero(np.abs(z) > OUTLIER_Z)
+            worst = outliers[np.argsort(-np.abs(z[outliers]))][:10]
+            (p1, p5, p95, p99) = np.percentile(v, [ 1, 5, 95, 99 ])
+            result.append({
+                'rail': rail, 'count': len(v), 'min': v.min(), 'p1': p1, 'p5': p5, 'median': median,
+                'p95': p95, 'p99': p99, 'max': v.max(), 'mad': mad, 'outliers': len(outliers),
+                'worst': [ (str(self.serial[i]), str(self.date[i]), float(values[i]), float(z[i])) for i in worst ],
+            })
+        return result
+
+    def scrap(self):
+        """Boards that never passed."""
+        np = self.np
+        (names, inverse) = np.unique(self.serial, return_inverse = True)
+        ever = np.bincount(inverse, weights = self.passed, minlength = len(names))
+        return int((ever == 0).sum()), len(names)
+
+def test_times(filename):
+    """Time per test from the run records of the stations: [ (test, runs, mean, p95, total, share) ]."""
+    import numpy as np
+    from runrecord import load_records
+    durations = { }
+    for record in load_records(filename):
+        for t in record.get('tests', [ ]):
+            if t.get('result') != 'skipped':
+                durations.setdefault(t['test'], [ ]).append(t.get('duration', 0.0))
+    total = sum(sum(d) for d in durations.values()) or 1.0
+    result = [ ]
+    for (test, d) in durations.items():
+        d = np.array(d)
+        result.append((test, len(d), d.mean(), np.percentile(d, 95), d.sum(), d.sum() / total))
+    return sorted(result, key = lambda r: -r[4])
+
+class Report:
+    """Collects sections of rows; renders them as text or as HTML."""
+    def __init__(self, title):
+        self.title = title
+        self.sections = [ ]
+
+    def section(self, title, header, rows, note = ''):
+        self.sections.append((title, header, rows, note))
+
+    @staticmethod
+    def cell(value):
+        if isinstance(value, float):
+            return f'{value:.3f}'
+        return str(value)
+
+    def text(self):
+        out = io.StringIO()
+        out.write(f'{self.title}\n{"=" * len(self.title)}\n')
+        for (title, header, rows, note) in self.sections:
+            out.write(f'\n{title}\n{"-" * len(title)}\n')
+            if note:
+                out.write(note + '\n')
+            cells = [ header ] + [ [ self.cell(v) for v in row ] for row in rows ]
+            widths = [ max(len(r[i]) for r in cells) for i in range(len(header)) ]
+            for r in cells:
+                out.write('  '.join(c.rjust(w) if i else c.ljust(w) for (i, (c, w)) in enumerate(zip(r, widths))).rstrip() + '\n')
+        return out.getvalue()
+
+    def html(self):
+        out = io.StringIO()
+        e = html.escape
+        out.write(f'<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>{e(self.title)}</title>\n'
+                  '<style>body{font-family:sans-serif} table{border-collapse:collapse;margin-bottom:1em} '
+                  'td,th{border:1px solid #ccc;padding:2px 8px;text-align:right} td:first-child{text-align:left}</style>'
+                  f'</head><body>\n<h1>{e(self.title)}</h1>\n')
+        for (title, header, rows, note) in self.sections:
+            out.write(f'<h2>{e(title)}</h2>\n')
+            if note:
+                out.write(f'<p>{e(note)}</p>\n')
+            out.write('<table><tr>' + ''.join(f'<th>{e(h)}</th>' for h in header) + '</tr>\n')
+            for row in rows:
+                out.write('<tr>' + ''.join(f'<td>{e(self.cell(v))}</td>' for v in row) + '</tr>\n')
+            out.write('</table>\n')
+        out.write('</body></html>\n')
+        return out.getvalue()
+
+def make_report(history, runs = None, top = 20):
+    report = Report(f'U64-II test history: {len(history)} runs')
+    (scrapped, boards) = history.scrap()
+    firsts = int(history.first.sum())
+    good = int(history.passed[history.first].sum())
+    report.section('Summary', [ 'measure', 'value' ], [
+        ('boards', boards),
+        ('runs', len(history)),
+        ('first pass yield', good / max(firsts, 1)),
+        ('retests per board', (len(history) - boards) / max(boards, 1)),
+        ('boards never passed', scrapped),
+    ])
+    header = [ 'key', 'boards', 'passed', 'yield' ]
+    report.section('First pass yield per day', header, history.yield_by(history.day))
+    report.section('First pass yield per git version', header, history.yield_by(history.git))
+    if history.revision is not None:
+        report.section('First pass yield per board revision', header, history.yield_by(history.revision))
+    report.section('Failures per test, all runs', [ 'test', 'count', 'cumulative' ], history.pareto()[:top])
+    report.section('Failures per test, first runs', [ 'test', 'count', 'cumulative' ], history.pareto(True)[:top])
+    stats = history.rail_stats()
+    report.section('Rail voltages', [ 'rail', 'count', 'min', 'p1', 'p5', 'median', 'p95', 'p99', 'max', 'outliers' ],
+                   [ [ s[k] for k in ('rail', 'count', 'min', 'p1', 'p5', 'median', 'p95', 'p99', 'max', 'outliers') ] for s in stats ],
+                   f'Outliers have a robust z-score (median / MAD) beyond {OUTLIER_Z}.')
+    worst = [ (s['rail'], ) + w for s in stats for w in s['worst'] ]
+    if worst:
+        report.section('Worst rail outliers', [ 'rail', 'serial', 'date', 'value', 'z' ], worst)
+    if runs:
+        report.section('Time per test', [ 'test', 'runs', 'mean', 'p95', 'total', 'share' ], test_times(runs))
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Yield, failure and voltage analysis of the test history.')
+    parser.add_argument('tests', help = 'export of the tests table (.csv, .jsonl or .jsonl.gz)')
+    parser.add_argument('--boards', help = 'export of the boards table, for yield per board revision')
+    parser.add_argument('--runs', help = 'run records of a station (logs/runs.jsonl), for the time per test')
+    parser.add_argument('--html', help = 'write an HTML report to this file instead of text to stdout')
+    parser.add_argument('--top', type = int, default = 20, help = 'number of tests in the failure Pareto')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    history = History(load_table(args.tests), load_table(args.boards, [ 'serial', 'board_rev' ]) if args.boards else None)
+    loaded = time.perf_counter()
+    report = make_report(history, args.runs, args.top)
+    if args.html:
+        with open(args.html, 'w', encoding = 'utf-8') as f:
+            f.write(report.html())
+    else:
+        sys.stdout.write(report.text())
+    print(f"Loaded in {loaded - start:.1f} sec., analyzed in {time.perf_counter() - loaded:.1f} sec.", file = sys.stderr)
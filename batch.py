@@ -0,0 +1,201 @@
+#!/usr/bin/python3
+import sys
+import json
+import time
+import queue
+import logging
+import argparse
+import threading
+from runner import BoardRunner
+from planconfig import PlanConfig
+from metrics import Metrics, MetricsExporter
+from runrecord import RunRecordWriter
+from tests import Ultimate64IITests
+from jtag_xilinx import JtagClient
+
+# Runs the tester without a window. Serial numbers come from a file or stdin, one per line, optionally
+# followed by the cable the board is attached to; without a cable, the first free station takes the board.
+# Each board results in one line of JSON on the output.
+
+class RunnerLogHandler(logging.Handler):
+    """Passes log records to the log of a runner. With several stations, only the records of the station's
+    own thread are taken."""
+    def __init__(self, write, thread = None):
+        logging.Handler.__init__(self)
+        self.write = write
+        self.thread = thread
+        self.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(message)s'))
+
+    def emit(self, record):
+        if self.thread is not None and record.thread != self.thread:
+            return
+        self.write(self.format(record) + '\n')
+
+class Station:
+    """One cable, with its own runner; takes boards until the input ends."""
+    def __init__(self, batch, url, index):
+        self.batch = batch
+        self.url = url
+        self.name = f'{index}'
+        self.boards = queue.Queue()
+        self.messages = [ ]
+        self.runner = BoardRunner(self, batch.database if batch.use_db else None, url, batch.records, batch.lock,
+                                  config = batch.config, metrics = batch.metrics)
+        self.runner.gitsha = batch.gitsha
+
+    # What the runner shows; there is no window, so only the log text and errors remain
+    def write(self, text):
+        if self.batch.verbose:
+            with self.batch.lock:
+                for line in text.splitlines():
+                    sys.stderr.write(f'[{self.name}] {line}\n')
+
+    def set_icon(self, name, passed):
+        pass
+
+    def set_stat(self, name, value):
+        pass
+
+    def set_progress(self, index, value):
+        pass
+
+    def show_error(self, title, msg):
+        self.messages.append(f'{title}: {msg}')
+        self.runner.write(f'{title}: {msg}\n')
+
+    def next_board(self):
+        while True:
+            for q in (self.boards, self.batch.boards):
+                try:
+                    serial = q.get(timeout = 0.1)
+                    self.batch.update_queue_depth()
+                    return serial
+                except queue.Empty:
+                    pass
+            if self.batch.input_done.is_set() and self.boards.empty() and self.batch.boards.empty():
+                return None
+
+    def run(self):
+        handler = RunnerLogHandler(self.runner.write, threading.get_ident() if len(self.batch.stations) > 1 else None)
+        Ultimate64IITests.add_log_handler(handler)
+        JtagClient.add_log_handler(handler)
+        while True:
+            serial = self.next_board()
+            if serial is None:
+                break
+            self.messages = [ ]
+            try:
+                summary = self.runner.run(serial, self.batch.rerun_failed)
+            except Exception as e:
+                # Whatever went wrong with this board, the next one gets its turn
+                self.messages.append(f'Error: {e}')
+                summary = { 'serial': serial, 'cable': self.url, 'passed': False }
+            if summary is None:
+                # The cable could not be opened; this station takes no more boards
+                self.batch.report({ 'serial': serial, 'cable': self.url, 'passed': False, 'messages': self.messages })
+                break
+            summary['messages'] = self.messages
+            self.batch.report(summary)
+
+class Batch:
+    def __init__(self, cables, output, use_db = True, rerun_failed = False, verbose = False, config = None, metrics = None):
+        self.output = output
+        self.config = config
+        self.metrics = metrics
+        self.use_db = use_db
+        self.rerun_failed = rerun_failed
+        self.verbose = verbose
+        self.lock = threading.Lock() # Output, run records and database writes are shared between stations
+        self.records = RunRecordWriter()
+        self.db = None
+        self.db_lock = threading.Lock()
+        self.gitsha = self.resolve_gitsha()
+        self.boards = queue.Queue()
+        self.input_done = threading.Event()
+        self.stations = { url: Station(self, url, idx) for idx, url in enumerate(cables) }
+        self.results = [ ]
+        self.queued = 0 # Boards read from the input
+
+    @staticmethod
+    def resolve_gitsha():
+        try:
+            import git
+            return git.Repo(search_parent_directories=True).head.object.hexsha
+        except Exception:
+            return 'unknown'
+
+    def database(self):
+        """Connects on first use; all stations share the connection."""
+        with self.db_lock:
+            if not self.db:
+                from db import Database
+                self.db = Database()
+                self.db.boards.start()
+            return self.db
+
+    def read_serials(self, lines):
+        for line in lines:
+            fields = line.split()
+            if not fields:
+                continue
+            if len(fields) > 1 and fields[1] in self.stations:
+                self.stations[fields[1]].boards.put(fields[0])
+            else:
+                self.boards.put(fields[0])
+            self.queued += 1
+            self.update_queue_depth()
+        self.input_done.set()
+
+    def update_queue_depth(self):
+        if self.metrics:
+            waiting = self.boards.qsize() + sum(s.boards.qsize() for s in self.stations.values())
+            self.metrics.set('queue_depth', waiting, queue = 'boards')
+
+    def report(self, summary):
+        line = json.dumps(summary, separators = (',', ':'), default = str)
+        with self.lock:
+            self.results.append(summary)
+            self.output.write(line + '\n')
+            self.output.flush()
+
+    def run(self, lines):
+        threading.Thread(target = self.read_serials, args = (lines, ), daemon = True).start()
+        threads = [ threading.Thread(target = s.run, name = f'station-{s.name}') for s in self.stations.values() ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # Boards that got no result, e.g. because a cable could not be opened, fail the batch too
+        return len(self.results) == self.queued and all(r['passed'] for r in self.results)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Tests and programs boards without the window; prints one JSON line per board.')
+    parser.add_argument('serials', nargs = '?', help = 'file with serial numbers, one per line (default: stdin)')
+    parser.add_argument('--cable', action = 'append', help = 'FTDI URL of a cable; repeat to run several boards at once')
+    parser.add_argument('--output', help = 'file for the JSON results (default: stdout)')
+    parser.add_argument('--no-db', action = 'store_true', help = 'do not check against, nor write to the database')
+    parser.add_argument('--rerun-failed', action = 'store_true', help = 'only rerun the tests that failed in the previous run of a board')
+    parser.add_argument('-v', '--verbose', action = 'store_true', help = 'print the test log on stderr')
+    parser.add_argument('--plan', help = 'test plan file, e.g. plans/fast.json (default: all tests)')
+    parser.add_argument('--metrics-file', help = 'keep throughput metrics in this file, in the Prometheus text format')
+    parser.add_argument('--metrics-port', type = int, help = 'serve throughput metrics on http://127.0.0.1:<port>/metrics')
+    args = parser.parse_args()
+
+    output = open(args.output, 'a') if args.output else sys.stdout
+    config = PlanConfig.load(args.plan) if args.plan else None
+    exporter = None
+    if args.metrics_file or args.metrics_port:
+        exporter = MetricsExporter(Metrics(), args.metrics_file, args.metrics_port).start()
+    batch = Batch(args.cable or [ 'ftdi://ftdi:232h/0' ], output, not args.no_db, args.rerun_failed, args.verbose, config,
+                  exporter.metrics if exporter else None)
+    start = time.time()
+    if args.serials:
+        with open(args.serials) as f:
+            ok = batch.run(f.readlines())
+    else:
+        ok = batch.run(sys.stdin)
+    print(f"{len(batch.results)} boards in {time.time() - start:.1f} sec.; "
+          f"{sum(1 for r in batch.results if r['passed'])} passed", file = sys.stderr)
+    if exporter:
+        exporter.stop()
+    exit(0 if ok else 1)
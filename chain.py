@@ -0,0 +1,47 @@
+#!/usr/bin/python3
+import sys
+import time
+import logging
+import argparse
+from tests import dut_fpga, DUT_USER_ID
+from jtag_xilinx import JtagClient, logger, ch
+
+# A fixture with several boards on one JTAG chain: scan the chain, or load the tester FPGA image into all
+# boards at once and check each of them.
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Multi-device JTAG chain: scan, or configure all FPGAs with one bitstream.')
+    parser.add_argument('command', choices = [ 'scan', 'load' ])
+    parser.add_argument('bitfile', nargs = '?', default = dut_fpga)
+    parser.add_argument('--url', default = 'ftdi://ftdi:232h/0')
+    parser.add_argument('--sim', type = int, help = 'use a simulated chain of this many devices')
+    parser.add_argument('--positions', help = 'positions to configure, e.g. 0,2 (default: all)')
+    parser.add_argument('-v', '--verbose', action = 'store_true')
+    args = parser.parse_args()
+
+    if args.verbose:
+        logger.addHandler(ch)
+    else:
+        logger.setLevel(logging.WARNING)
+    if args.sim:
+        from simdut import SimulatedChain
+        dut = SimulatedChain(args.sim)
+    else:
+        dut = JtagClient(args.url)
+    chain = dut.scan_chain()
+    for (p, idcode) in enumerate(chain):
+        print(f"{p:3d}  {'bypass only' if idcode is None else f'IDCODE {idcode:08x}'}")
+    if args.command == 'scan':
+        exit(0)
+
+    positions = [ int(p) for p in args.positions.split(',') ] if args.positions else None
+    start = time.perf_counter()
+    devices = dut.broadcast_load_fpga(args.bitfile, positions)
+    elapsed = time.perf_counter() - start
+    ok = True
+    for d in devices:
+        good = d['user_id'] == DUT_USER_ID
+        ok = ok and good
+        print(f"{d['position']:3d}  DNA {d['dna']:016X}  user ID {d['user_id']:08x}  {'ok' if good else 'NOT CONFIGURED'}")
+    print(f"{len(devices)} devices in {elapsed:.2f} sec.; {elapsed / max(len(devices), 1):.2f} sec. per board", file = sys.stderr)
+    exit(0 if ok else 1)
@@ -0,0 +1,47 @@
+import os
+import json
+
+class Checkpoint:
+    """Progress of the run of one board, saved after every test, such that an interrupted or partly
+    failed run can be resumed without repeating the tests that already passed."""
+    def __init__(self, serial, directory = 'logs'):
+        self.filename = os.path.join(directory, f'{serial}.checkpoint.json')
+        self.serial = serial
+        self.dna = None
+        self.passed = [ ]
+        self.failed = [ ]
+        self.values = { }
+
+    @staticmethod
+    def load(serial, directory = 'logs'):
+        """Returns the saved checkpoint of a board, or None when there is none."""
+        cp = Checkpoint(serial, directory)
+        if not os.path.exists(cp.filename):
+            return None
+        with open(cp.filename, "r") as f:
+            data = json.load(f)
+        cp.dna = data['dna']
+        cp.passed = data['passed']
+        cp.failed = data['failed']
+        cp.values = data['values']
+        return cp
+
+    def save(self):
+        data = { 'serial': self.serial, 'dna': self.dna, 'passed': self.passed, 'failed': self.failed, 'values': self.values }
+        tmpname = self.filename + '.tmp'
+        with open(tmpname, "w") as f:
+            json.dump(data, f)
+        os.replace(tmpname, self.filename)
+
+    def record(self, name, passed, values):
+        if name in self.passed:
+            self.passed.remove(name)
+        if name in self.failed:
+            self.failed.remove(name)
+        (self.passed if passed else self.failed).append(name)
+        self.values = values
+        self.save()
+
+    def remove(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
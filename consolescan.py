@@ -0,0 +1,74 @@
+from collections import deque
+
+FATAL = 'fatal' # The test failed; there is no need to wait for it to complete
+PASS = 'pass'
+
+LINE_MAX = 1024 # Longest part of an unterminated line that is kept, to show with a match
+
+class ConsoleScanner:
+    """Matches all signatures at once over the console text as it is read from the DUT (Aho-Corasick): every
+    character is looked at once, however many signatures there are, and a signature may be split over two reads.
+    signatures is { text: kind }; kind is FATAL or PASS."""
+    def __init__(self, signatures):
+        self.goto = [ { } ]
+        self.fail = [ 0 ]
+        self.out = [ [ ] ]
+        for (text, kind) in signatures.items():
+            if not text:
+                continue
+            state = 0
+            for c in text:
+                nxt = self.goto[state].get(c)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[state][c] = nxt
+                    self.goto.append({ })
+                    self.fail.append(0)
+                    self.out.append([ ])
+                state = nxt
+            self.out[state].append((text, kind))
+        # Breadth first, so the fail link of a state is always done before those of its children
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for (c, nxt) in self.goto[state].items():
+                queue.append(nxt)
+                f = self.fail[state]
+                while f and c not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(c, 0)
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+        self.reset()
+
+    def reset(self):
+        self.state = 0
+        self.line = '' # The unterminated last line of the text so far
+        self.matches = [ ] # (signature, kind, line)
+        self.fatal = None # The first FATAL match
+
+    def feed(self, text):
+        """Scans the next piece of console text; returns the matches in it."""
+        (goto, fail, out) = (self.goto, self.fail, self.out)
+        state = self.state
+        found = [ ]
+        for (i, c) in enumerate(text):
+            while state and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            if out[state]:
+                found.append((i, out[state]))
+        self.state = state
+
+        new = [ ]
+        for (i, signatures) in found:
+            begin = text.rfind('\n', 0, i) + 1
+            end = text.find('\n', i)
+            line = ((self.line if begin == 0 else '') + text[begin:end if end >= 0 else len(text)]).strip()
+            for (signature, kind) in signatures:
+                new.append((signature, kind, line))
+                if kind == FATAL and not self.fatal:
+                    self.fatal = (signature, line)
+        last = text.rfind('\n')
+        self.line = (self.line + text if last < 0 else text[last + 1:])[-LINE_MAX:]
+        self.matches += new
+        return new
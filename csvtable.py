@@ -1,10 +1,36 @@
 import csv
 import unicodedata
+import bisect
 import io
+import gzip
+import json
+import sys
+from decimal import Decimal
     
+NGRAM = 3
+
+def ngrams(text):
+    return { text[i:i + NGRAM] for i in range(len(text) - NGRAM + 1) }
+
 def normalize_caseless(text):
     return unicodedata.normalize("NFKD", text.upper().lower()) #-- .decode('unicode-escape')
 
+def json_default(value):
+    # DynamoDB hands out numbers as Decimal
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    return str(value)
+
+def open_output(filename, encoding = 'utf-8', compress = None):
+    """Opens a large-buffered text file for writing; gzip compressed when asked, or when the name ends with .gz."""
+    if compress is None:
+        compress = filename.endswith('.gz')
+    if compress:
+        return gzip.open(filename, "wt", compresslevel = 6, encoding = encoding, errors = 'ignore', newline = '')
+    return io.open(filename, "w", buffering = 1024 * 1024, encoding = encoding, errors = 'ignore', newline = '')
+
 def caseless_equal(left, right):
     if len(left) == 0:
         return False
@@ -23,64 +49,126 @@ def caseless_in(left, right):
         return True
     return b in a
 
+def matcher(match):
+    """Returns a function that tells whether a row caseless-matches all key/value pairs of match."""
+    # Normalize the wanted values once, instead of once per row
+    wanted = [ (k, normalize_caseless(v)) for (k, v) in match.items() ]
+    if any(len(v) == 0 for (_k, v) in wanted):
+        return lambda row: False
+    def matches(row):
+        for (k, v) in wanted:
+            if len(row[k]) == 0 or normalize_caseless(row[k]) != v:
+                return False
+        return True
+    return matches
+
+def open_reader(csvfile, delimiter = ',', skip_first = False, skip_bom = False):
+    if skip_bom:
+        csvfile.read(1)
+    if skip_first:
+        next(csvfile)
+    return csv.DictReader(csvfile, dialect='excel', delimiter=delimiter)
+
 class CsvTable(object):
     def __init__(self, filename, delimiter = ',', skip_first = False, encoding = 'utf-8', skip_bom = False):
-        import io
-        with io.open(filename, 'r', encoding = encoding) as csvfile:
-            if skip_bom:
-                csvfile.read(1)
-            if skip_first:
-                csvfile.next()
-                
-            Reader = csv.DictReader(csvfile, dialect='excel', delimiter=delimiter)
+        with io.open(filename, 'r', encoding = encoding, newline = '') as csvfile:
+            Reader = open_reader(csvfile, delimiter, skip_first, skip_bom)
             self.columns = Reader.fieldnames
             self.rows = []
             for row in Reader:
                 self.rows.append(row)
+        self.invalidate()
+
+    @classmethod
+    def from_rows(cls, columns, rows):
+        table = cls.__new__(cls)
+        table.columns = columns
+        table.rows = list(rows)
+        table.invalidate()
+        return table
+
+    @staticmethod
+    def create(filename, fields, rows, delimiter = ',', encoding = 'utf-8', compress = None):
+        """Writes rows (any iterable of dicts, e.g. a database scan) to a CSV file. Missing fields are left empty."""
+        with open_output(filename, encoding, compress) as outfile:
+            writer = csv.writer(outfile, delimiter = delimiter, quoting = csv.QUOTE_ALL, lineterminator = "\n")
+            writer.writerow(fields)
+            writer.writerows([ row.get(f, '') for f in fields ] for row in rows)
 
     @staticmethod
-    def create(filename, fields, rows, delimiter = ',', encoding = 'utf-8'):
-        with io.open(filename, "wb") as outfile:
-            header = delimiter.join(fields) + "\n"
-            outfile.write(header.encode(encoding, errors = 'ignore'))
-            for row in rows:
-                elements = [ ]
-                for f in fields:
-                    if f in row:
-                        st = str(row[f])
-                        if len(st) > 0:
-                            elements.append('"' + str(row[f]) + '"')
-                        else:
-                            elements.append('')
-                    else:
-                        elements.append('')
-                line = delimiter.join(elements) + "\n"
-                outfile.write(line.encode(encoding, errors = 'ignore'))
+    def create_jsonl(filename, rows, encoding = 'utf-8', compress = None):
+        with open_output(filename, encoding, compress) as outfile:
+            outfile.writelines(json.dumps(row, default = json_default) + "\n" for row in rows)
         
+    def invalidate(self):
+        """Drops the lookup indexes. Must be called after changing self.rows directly."""
+        self._index = { }
+        self._caseless = { }
+        self._sorted = { }
+        self._ngram = { }
+
+    def index(self, key):
+        """Returns a map of value -> row positions for one column, built on first use."""
+        idx = self._index.get(key)
+        if idx is None:
+            idx = { }
+            for pos, row in enumerate(self.rows):
+                idx.setdefault(row[key], []).append(pos)
+            self._index[key] = idx
+        return idx
+
+    def caseless_index(self, key):
+        """Like index(), but on the normalized values. Empty values never match, so they are left out."""
+        idx = self._caseless.get(key)
+        if idx is None:
+            idx = { }
+            for pos, row in enumerate(self.rows):
+                if len(row[key]) > 0:
+                    idx.setdefault(normalize_caseless(row[key]), []).append(pos)
+            self._caseless[key] = idx
+        return idx
+
+    def sorted_index(self, key):
+        """Returns (values, positions) of one column, ordered by value."""
+        idx = self._sorted.get(key)
+        if idx is None:
+            order = sorted(range(len(self.rows)), key = lambda pos: self.rows[pos][key])
+            idx = ([ self.rows[pos][key] for pos in order ], order)
+            self._sorted[key] = idx
+        return idx
+
     def sort(self, Key):
         self.rows = sorted(self.rows, key = lambda k: k[Key])
+        self.invalidate()
         
     def find_first(self, key, value):
-        for i in self.rows:
-            if i[key] == value:
-                return i
+        positions = self.index(key).get(value)
+        if positions:
+            return self.rows[positions[0]]
                 
     def find_entries(self, key, value):
-        ret = []
-        for i in self.rows:
-            if i[key] == value:
-                ret.append(i)
-        return ret
+        return [ self.rows[pos] for pos in self.index(key).get(value, []) ]
     
     def find_range(self, key, _from, _to):
-        ret = []
-        for i in self.rows:
-            if (i[key] >= _from) and (i[key] < _to):
-                ret.append(i)
-        return ret
+        (values, order) = self.sorted_index(key)
+        first = bisect.bisect_left(values, _from)
+        last = bisect.bisect_left(values, _to, first)
+        # Return the rows in table order, like a plain scan would
+        return [ self.rows[pos] for pos in sorted(order[first:last]) ]
 
     def find_last(self, match):
-        for i in reversed(self.rows):
+        if not match:
+            return self.rows[-1] if self.rows else None
+        # Walk the shortest candidate list; the other keys are then checked row by row
+        candidates = None
+        for k in match.keys():
+            if len(match[k]) == 0:
+                return None
+            positions = self.caseless_index(k).get(normalize_caseless(match[k]), [])
+            if candidates is None or len(positions) < len(candidates):
+                candidates = positions
+        for pos in reversed(candidates):
+            i = self.rows[pos]
             found = True
             for k in match.keys():
                 if not caseless_equal(i[k], match[k]):
@@ -89,47 +177,140 @@ class CsvTable(object):
             if found:
                 return i
 
+    def ngram_index(self, key):
+        """Returns (position -> normalized value, normalized value -> positions, n-gram -> positions) of one
+        column, built on first use. Values shorter than 6 characters never match in find_substring(); they are
+        left out."""
+        idx = self._ngram.get(key)
+        if idx is None:
+            values = { }
+            exact = { }
+            postings = { }
+            for pos, row in enumerate(self.rows):
+                if len(row[key]) < 6:
+                    continue
+                value = normalize_caseless(row[key])
+                values[pos] = value
+                exact.setdefault(value, []).append(pos)
+                for gram in ngrams(value):
+                    postings.setdefault(gram, []).append(pos)
+            idx = (values, exact, postings)
+            self._ngram[key] = idx
+        return idx
+
+    def substring_candidates(self, key, text):
+        """Returns the positions of the rows of which the column contains text, or is contained in it (caseless)."""
+        (values, exact, postings) = self.ngram_index(key)
+        wanted = normalize_caseless(text)
+        found = set()
+
+        # Values inside 'wanted' are one of its substrings, which are few enough to look up one by one
+        for start in range(len(wanted)):
+            for end in range(start + 1, len(wanted) + 1):
+                found.update(exact.get(wanted[start:end], ()))
+
+        # Values containing 'wanted' contain each of its n-grams; the rarest one gives the shortest candidate list
+        grams = ngrams(wanted)
+        if grams:
+            candidates = min((postings.get(gram, ()) for gram in grams), key = len)
+        else:
+            candidates = values.keys()
+        found.update(pos for pos in candidates if wanted in values[pos])
+        return found
+
     def find_substring(self, match):
-        for i in reversed(self.rows):
-            found = True
-            for k in match.keys():
-                if len(i[k]) < 6 or len(match[k]) < 6 or not caseless_in(i[k], match[k]):
-                    found = False
-                    break
-            if found:
-                return i
+        if not match:
+            return self.rows[-1] if self.rows else None
+        found = None
+        for k in match.keys():
+            if len(match[k]) < 6:
+                return None
+            positions = self.substring_candidates(k, match[k])
+            found = positions if found is None else found & positions
+            if not found:
+                return None
+        # Last match wins
+        return self.rows[max(found)]
 
     def filter_remove(self, match):
-        n = []
-        for i in self.rows:
-            match = True
-            for k in match.keys():
-                if not caseless_equal(i[k], match[k]):
-                    match = False
-                    break
-            if not match:
-                n.append(i)
-        
-        self.rows = n
+        matches = matcher(match)
+        self.rows = [ i for i in self.rows if not matches(i) ]
+        self.invalidate()
             
     def filter_keep(self, match):
-        n = []
-        for i in self.rows:
-            match = True
-            for k in match.keys():
-                if not caseless_equal(i[k], match[k]):
-                    match = False
-                    break
-            if match:
-                n.append(i)
-        
-        self.rows = n
+        matches = matcher(match)
+        self.rows = [ i for i in self.rows if matches(i) ]
+        self.invalidate()
 
     def write_back(self, filename, rows=None):
         if rows == None:
             rows = self.rows
-        writer = csv.DictWriter(open(filename, 'w'), fieldnames = self.columns) #, dialect='excel')
-        writer.writerow(dict((fn,fn) for fn in self.columns))
+        CsvTable.create(filename, self.columns, rows)
+    
+class ColumnTable(object):
+    """Rows stored as one list per column instead of one dict per row; repeated values share one string."""
+    def __init__(self, columns, rows = ()):
+        self.columns = columns
+        self.data = { c: [] for c in columns }
         for row in rows:
-            writer.writerow(row)
-    
\ No newline at end of file
+            self.append(row)
+
+    def append(self, row):
+        for c in self.columns:
+            value = row.get(c)
+            self.data[c].append(sys.intern(value) if isinstance(value, str) else value)
+
+    def __len__(self):
+        return len(self.data[self.columns[0]]) if self.columns else 0
+
+    def column(self, name):
+        return self.data[name]
+
+    def row(self, index):
+        return { c: self.data[c][index] for c in self.columns }
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.row(i)
+
+class CsvStream(object):
+    """Lazy counterpart of CsvTable: rows are read from the file while iterating, and the filters are applied
+    on the fly. Rows are only held in memory when sorting, or when converted with to_table() / to_columns()."""
+    def __init__(self, filename, delimiter = ',', skip_first = False, encoding = 'utf-8', skip_bom = False):
+        self.filename = filename
+        self.delimiter = delimiter
+        self.skip_first = skip_first
+        self.encoding = encoding
+        self.skip_bom = skip_bom
+        self.filters = [ ]
+        with io.open(filename, 'r', encoding = encoding, newline = '') as csvfile:
+            self.columns = open_reader(csvfile, delimiter, skip_first, skip_bom).fieldnames
+
+    def __iter__(self):
+        with io.open(self.filename, 'r', encoding = self.encoding, newline = '') as csvfile:
+            for row in open_reader(csvfile, self.delimiter, self.skip_first, self.skip_bom):
+                if all(f(row) for f in self.filters):
+                    yield row
+
+    def filter_keep(self, match):
+        self.filters.append(matcher(match))
+        return self
+
+    def filter_remove(self, match):
+        matches = matcher(match)
+        self.filters.append(lambda row: not matches(row))
+        return self
+
+    def to_table(self):
+        return CsvTable.from_rows(self.columns, self)
+
+    def to_columns(self):
+        return ColumnTable(self.columns, self)
+
+    def sort(self, Key):
+        table = self.to_table()
+        table.sort(Key)
+        return table
+
+    def write_back(self, filename):
+        CsvTable.create(filename, self.columns, self)
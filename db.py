@@ -1,6 +1,128 @@
 import boto3 as aws
 import botocore
 import os
+import json
+import time
+import queue
+import threading
+from boto3.dynamodb.conditions import Attr
+from datetime import datetime, timedelta, timezone
+from csvtable import CsvTable, json_default
+
+BOARD_FIELDS = [ 'serial', 'fpga_id', 'flash_id', 'board_rev' ]
+TEST_FIELDS = [ 'serial', 'flash_id', 'fpga_id', 'date', 'vbus', 'vaux', 'vusb', 'v50', 'v33', 'v18', 'v10',
+                'git', 'flashed', 'booted', 'critical', 'failed' ]
+
+# Boards written by stations that do not stamp 'updated' only show up in a full sync
+FULL_SYNC_INTERVAL = 3600
+
+class BoardCache:
+    """Local copy of the u64ii_boards table, indexed on serial, FPGA ID and Flash ID."""
+    def __init__(self, db, filename = 'logs/boards.json', interval = 60):
+        self.db = db
+        self.filename = filename
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.by_serial = { }
+        self.by_fpga_id = { }
+        self.by_flash_id = { }
+        self.synced = '' # 'updated' timestamp from which the next incremental sync starts
+        self.full_synced = time.monotonic() # When the whole table was read last; the cache on disk counts
+        self.attempted = threading.Event() # The first sync of this session has finished, or failed
+        self.ready = threading.Event() # A sync of this session has completed
+        self.error = None
+        self.stop = threading.Event()
+        self.thread = None
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Ignoring board cache {self.filename}: {e}")
+            return
+        for item in data['boards']:
+            self.update(item)
+        self.synced = data['synced']
+
+    def save(self):
+        with self.lock:
+            data = { 'synced': self.synced, 'boards': list(self.by_serial.values()) }
+        tmpname = self.filename + '.tmp'
+        with open(tmpname, "w") as f:
+            json.dump(data, f, default = json_default)
+        os.replace(tmpname, self.filename)
+
+    def update(self, item):
+        with self.lock:
+            serial = item['serial']
+            old = self.by_serial.get(serial)
+            if old:
+                if self.by_fpga_id.get(old.get('fpga_id')) == serial:
+                    del self.by_fpga_id[old['fpga_id']]
+                if self.by_flash_id.get(old.get('flash_id')) == serial:
+                    del self.by_flash_id[old['flash_id']]
+            self.by_serial[serial] = item
+            if 'fpga_id' in item:
+                self.by_fpga_id[item['fpga_id']] = serial
+            if 'flash_id' in item:
+                self.by_flash_id[item['flash_id']] = serial
+
+    def sync(self):
+        """Fetches all boards changed since the previous sync. The first sync, and one every FULL_SYNC_INTERVAL
+        seconds, read the whole table, for the boards without an 'updated' stamp."""
+        # Overlap with the previous sync window, to tolerate clock differences between stations
+        started = datetime.now(timezone.utc) - timedelta(minutes = 5)
+        full = not self.synced or time.monotonic() - self.full_synced > FULL_SYNC_INTERVAL
+        if full:
+            items = self.db.scan(self.db.u64ii_boards, 4)
+        else:
+            items = self.db.scan(self.db.u64ii_boards, 4, FilterExpression = Attr('updated').gte(self.synced))
+        for item in items:
+            self.update(item)
+        self.synced = started.isoformat()
+        if full:
+            self.full_synced = time.monotonic()
+        self.save()
+
+    def run(self):
+        while not self.stop.is_set():
+            try:
+                self.sync()
+                self.error = None
+                self.ready.set()
+            except Exception as e:
+                self.error = e
+                print(f"Board cache sync failed: {e}")
+            self.attempted.set()
+            self.stop.wait(self.interval)
+
+    def start(self):
+        if not self.thread:
+            self.thread = threading.Thread(target = self.run, daemon = True)
+            self.thread.start()
+
+    def wait(self, timeout = 10):
+        """Waits a little for the first sync of this session. Raises when it has not completed, as the cache on
+        disk may be missing boards that were tested since."""
+        self.attempted.wait(timeout)
+        if self.ready.is_set():
+            return
+        if self.error:
+            raise Exception(f"The board cache could not be synced with the database: {self.error}")
+        raise Exception("The board cache is still being synced with the database; try again in a minute.")
+
+    def get_board(self, serial):
+        return self.by_serial.get(serial)
+
+    def get_serial(self, fpga_id):
+        return self.by_fpga_id.get(fpga_id)
+
+    def get_serial_by_flash_id(self, flash_id):
+        return self.by_flash_id.get(flash_id)
 
 class Database:
     def __init__(self):
@@ -9,32 +131,130 @@ class Database:
             self.ACCESS_KEY = lines[0].strip()
             self.SECRET_KEY = lines[1].strip()
         self.open_tables()
+        self.boards = BoardCache(self)
+
+    def resource(self):
+        # boto3 resources are not thread safe, so every scan thread asks for its own
+        session = aws.session.Session()
+        return session.resource('dynamodb', region_name = 'us-east-1', aws_access_key_id = self.ACCESS_KEY, aws_secret_access_key = self.SECRET_KEY)
 
     def open_tables(self):
-        dynamodb = aws.resource('dynamodb', region_name = 'us-east-1', aws_access_key_id = self.ACCESS_KEY, aws_secret_access_key = self.SECRET_KEY)
+        dynamodb = self.resource()
         self.test = dynamodb.Table('test')
         self.u64ii_boards = dynamodb.Table('u64ii_boards')
         self.u64ii_tests = dynamodb.Table('u64ii_tests')
         self.u64ii_logs = dynamodb.Table('u64ii_logs')
 
+    def scan_segment(self, table, segment = 0, segments = 1, **kwargs):
+        """Yields all items of one scan segment, following LastEvaluatedKey page by page."""
+        if segments > 1:
+            kwargs['Segment'] = segment
+            kwargs['TotalSegments'] = segments
+        while True:
+            response = table.scan(**kwargs)
+            for item in response['Items']:
+                yield item
+            if 'LastEvaluatedKey' not in response:
+                break
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def scan(self, table, segments = 1, **kwargs):
+        """Yields all items of a table lazily. With segments > 1, the scan is split over as many threads."""
+        if segments <= 1:
+            yield from self.scan_segment(table, **kwargs)
+            return
+
+        # The queue is bounded, such that memory stays constant when the consumer is slower than the scanners
+        items = queue.Queue(maxsize = 1000)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    items.put(item, timeout = 0.5)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def worker(segment):
+            try:
+                own = self.resource().Table(table.name)
+                for item in self.scan_segment(own, segment, segments, **kwargs):
+                    if not put(item):
+                        return
+                put(done)
+            except Exception as e:
+                put(e)
+
+        threads = [ threading.Thread(target = worker, args = (seg, ), daemon = True) for seg in range(segments) ]
+        for t in threads:
+            t.start()
+        try:
+            running = segments
+            while running:
+                item = items.get()
+                if item is done:
+                    running -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            stop.set()
+
+    def query(self, table, **kwargs):
+        """Yields all items matching a query, following LastEvaluatedKey page by page."""
+        while True:
+            response = table.query(**kwargs)
+            for item in response['Items']:
+                yield item
+            if 'LastEvaluatedKey' not in response:
+                break
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
     def dump_sandbox(self):
-        for item in self.test.scan()['Items']:
+        for item in self.scan(self.test):
             print(item)
 
     def dump_boards(self):
-        for item in self.u64ii_boards.scan()['Items']:
+        for item in self.scan(self.u64ii_boards):
             print(item)
 
     def dump_tests(self):
-        for item in self.u64ii_tests.scan()['Items']:
+        for item in self.scan(self.u64ii_tests):
             print(item)
 
+    def export(self, table, filename, fields = None, segments = 4):
+        """Streams a table to a CSV or (when the filename ends with .jsonl) a JSON lines file. Add .gz to compress."""
+        items = self.scan(table, segments)
+        if filename.endswith('.jsonl') or filename.endswith('.jsonl.gz'):
+            CsvTable.create_jsonl(filename, items)
+        else:
+            CsvTable.create(filename, fields, items)
+
     def get_board(self, serial):
         response = self.u64ii_boards.get_item(Key = { 'serial' : serial })
         if 'Item' in response:
+            self.boards.update(response['Item'])
             return response['Item']
 
+    def get_serial(self, fpga_id):
+        """Returns the serial number that the FPGA ID was last registered with. The table has no index on
+        FPGA ID, so the board cache finds the candidate, and the table itself confirms it."""
+        self.boards.wait()
+        serial = self.boards.get_serial(fpga_id)
+        if not serial:
+            return None
+        board = self.get_board(serial)
+        if board and board.get('fpga_id') == fpga_id:
+            return serial
+        return None
+
     def add_board(self, dct):
+        dct = dict(dct, updated = datetime.now(timezone.utc).isoformat())
+        self.boards.update(dct)
         try:
             response = self.u64ii_boards.put_item(Item = dct)
         except botocore.errorfactory.ResourceNotFoundException as e:
@@ -53,7 +273,23 @@ class Database:
             print(e)
 
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description = 'U64-II tester database tool')
+    sub = parser.add_subparsers(dest = 'command')
+    exp = sub.add_parser('export', help = 'stream a table to a .csv or .jsonl file, optionally .gz compressed')
+    exp.add_argument('table', choices = [ 'tests', 'boards' ])
+    exp.add_argument('filename')
+    exp.add_argument('--segments', type = int, default = 4, help = 'number of parallel scan segments')
+    args = parser.parse_args()
+
     db = Database()
+    if args.command == 'export':
+        if args.table == 'tests':
+            db.export(db.u64ii_tests, args.filename, TEST_FIELDS, args.segments)
+        else:
+            db.export(db.u64ii_boards, args.filename, BOARD_FIELDS, args.segments)
+        exit()
+
     print("BOARDS:")
     db.dump_boards()
     print("SANDBOX:")
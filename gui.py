@@ -1,27 +1,33 @@
 #!/usr/bin/python3
 
+import time
+startup_time = time.perf_counter()
+
 import tkinter as tk
 import logging
-import git
-import time
+import logging.handlers
+import sys
+import queue
+import threading
 #import cv2
 from tkinter import ttk, messagebox
 import tkinter.scrolledtext as tkscrolled
-from PIL import ImageTk, Image
 from pprint import pprint
-from tests import Ultimate64IITests, TestFail, TestFailCritical, JtagClientException
-from datetime import datetime
-from db import Database
-from decimal import *
-from pyftdi.usbtools import UsbToolsError
+from tests import Ultimate64IITests
+from runner import BoardRunner
+from planconfig import PlanConfig
+from metrics import Metrics, MetricsExporter
 from jtag_xilinx import JtagClient
 
+# boto3, git, pyftdi and numpy are imported on first use, mostly on background threads, such that the
+# window comes up without waiting for them, nor for the network.
+
 # sudo apt install python3-pil python3-pil.imagetk
 
 class TextboxLogHandler(logging.StreamHandler):
-    def __init__(self, widget):
+    def __init__(self, write):
         logging.StreamHandler.__init__(self)
-        self.widget = widget
+        self.write = write
 
     def emit(self, record):
         # Record has: name, msg, args, levelname, levelno, pathname, filename, module,
@@ -31,9 +37,32 @@ class TextboxLogHandler(logging.StreamHandler):
             text = self.formatter.format(record)
         else:
             text = record.message
-        self.widget.insert(tk.END, text + '\n')
-        self.widget.see(tk.END)
-        self.widget.update()
+        self.write(text + '\n') # No widget access here; records may come from the test thread
+
+class LogSink:
+    """Log records go to the board log right away, in the thread that logs them, so the log that is saved and
+    uploaded at the end of a board is complete; the textbox is updated through the event queue. The full log on
+    disk is written by a listener thread, so a logging call in the test flow never waits for the disk. It gets
+    the log records, and through write() the text of the runner."""
+    def __init__(self, write, filename = 'logs/tester.log'):
+        self.queue = queue.SimpleQueue()
+        textbox = TextboxLogHandler(write)
+        textbox.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(message)s'))
+        disk = logging.handlers.RotatingFileHandler(filename, maxBytes = 16 * 1024 * 1024, backupCount = 5)
+        disk.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+        self.handlers = (textbox, logging.handlers.QueueHandler(self.queue))
+        self.listener = logging.handlers.QueueListener(self.queue, disk)
+
+    def write(self, text):
+        text = text.rstrip('\n')
+        if text:
+            self.queue.put(logging.makeLogRecord({ 'name': 'Runner', 'levelno': logging.INFO, 'levelname': 'INFO', 'msg': text }))
+
+    def start(self):
+        self.listener.start()
+
+    def stop(self):
+        self.listener.stop()
 
 class InfoField:
     def __init__(self, parent, name, col, row, label_width, info_width):
@@ -53,7 +82,6 @@ class InfoField:
     def info(self, data):
         self._info = data
         self.entry.configure(text = data)
-        self.frame.update()
 
 class InfoFields:
     def __init__(self, parent, fields, col, row, label_width, info_width):
@@ -72,186 +100,180 @@ class InfoFields:
             self.fields[stat].info = ""
 
 class MyGui:
-    def __init__(self):
-        self.CollectTests()
-        self.db = Database()
-        repo = git.Repo(search_parent_directories=True)
-        self.gitsha = repo.head.object.hexsha
-
-    def CollectTests(self):
-        self.testsuite = Ultimate64IITests()
-        self.after = { }
-        functions = self.testsuite.get_all_tests()
-        self.functions = { }
-        for (name, func) in functions.items():
-            if func.__doc__:
-                self.functions[name] = (func, func.__doc__)
-            else:
-                self.functions[name] = (func, name[9:])
-
-        self.after['test_008_get_voltages'] = self.UpdateVoltages
-        self.after['test_001_unique_id'] = self.UpdateUniqueId
-        self.after['test_003_board_revision'] = self.UpdateBoardRevision
-        self.testsuite.esp_callback = self.FlashUpdateESP32
-
-    def FlashUpdateESP32(self, val):
-        self.progress[0]['value'] = val
-        self.progress[0].update()
-
-    def FlashUpdateFPGA(self, val):
-        self.progress[1]['value'] = val
-        self.progress[1].update()
-
-    def FlashUpdateAppl(self, val):
-        self.progress[2]['value'] = val
-        self.progress[2].update()
-
-    def FlashUpdateFAT(self, val):
-        self.progress[3]['value'] = val
-        self.progress[3].update()
+    def __init__(self, connect = True, config = None, metrics = None):
+        self.runner = BoardRunner(self, self.Database, config = config, metrics = metrics)
+        self.testsuite = self.runner.testsuite
+        self.functions = self.runner.functions
+        self.db = None
+        self.db_error = None
+        self.db_ready = threading.Event()
+        self.gitsha = 'unknown'
+        self.git_ready = threading.Event()
+        self.probe = None
+        if connect:
+            threading.Thread(target = self.ConnectDatabase, daemon = True).start()
+        else:
+            self.runner.database = None
+        threading.Thread(target = self.ResolveGitSha, daemon = True).start()
+        self.events = queue.Queue()
+        self.worker = None
+        self.refresh_ms = 100 # Textbox is updated at most this often
+        self.max_lines = 5000 # Older lines are trimmed from the textbox; the full log is on disk
+
+    def ConnectDatabase(self):
+        try:
+            from db import Database
+            db = Database()
+            db.boards.start()
+            self.db = db
+        except Exception as e:
+            self.db_error = e
+        self.db_ready.set()
 
-    def StartButtonClick(self, param):
-        self.window.after(10, self.ExecuteTests)
+    def Database(self):
+        """Returns the database, waiting for the connection made at startup."""
+        self.db_ready.wait()
+        if not self.db:
+            raise Exception(f"No database connection: {self.db_error}")
+        return self.db
 
-    def RunOneTest(self, name):
-        (func, doc) = self.functions[name]
-        self.textbox.insert(tk.END, f"Running test '{doc}'\n{'-' * (14 + len(doc))}\n")
-        self.textbox.see(tk.END)
-        self.window.update()
-        critical = False
+    def ResolveGitSha(self):
         try:
-            func(self.testsuite)
-            self.test_icon_canvases[name].itemconfig(self.test_icon_images[name], image = self.img_pass)
-            self.textbox.insert(tk.END, "-> Result: OK!\n\n")
-        except TestFailCritical as e:
-            self.test_icon_canvases[name].itemconfig(self.test_icon_images[name], image = self.img_fail)
-            self.textbox.insert(tk.END, "-> Result: CRITICAL FAILURE!\n")
-            self.textbox.insert(tk.END, f"Reason: {e}\n\n")
-            critical = True
-            self.errors += 1
-            self.critical = True
-        except TestFail as e:
-            self.test_icon_canvases[name].itemconfig(self.test_icon_images[name], image = self.img_fail)
-            self.textbox.insert(tk.END, "-> Result: FAIL!\n")
-            self.textbox.insert(tk.END, f"Reason: {e}\n\n")
-            self.failed_tests.append(name[5:8]) # Add number to list
-            self.errors += 1
-        except JtagClientException as e:
-            messagebox.showerror("Failure!", f"Communication Error!\n{e}\nRestart Tester Application!")
-            exit()
+            import git
+            repo = git.Repo(search_parent_directories=True)
+            self.gitsha = repo.head.object.hexsha
+            self.runner.gitsha = self.gitsha
         except Exception as e:
-            self.textbox.insert(tk.END, "-> Result: ERROR!\n")
-            self.textbox.insert(tk.END, f"Reason: {e}\n\n")
-            self.critical = True
-            self.errors += 1
+            print(f"Could not determine git version: {e}")
+        self.git_ready.set()
 
-        if name in self.after:
+    def ProbeCable(self):
+        # Opening the cable can take a while; it is done while the operator reads the welcome message
+        try:
+            self.testsuite.startup(self.runner.url)
+        except Exception:
+            pass # The runner tries again, and reports the problem
+
+    # The tests run on a worker thread, which may not touch Tk. Everything it wants to show
+    # is posted to the event queue, which the main thread drains in batches on a timer.
+    def Post(self, func, *args):
+        self.events.put((func, args))
+
+    def Call(self, func, *args):
+        """Runs func on the main thread and waits for its result, e.g. for a message box."""
+        done = threading.Event()
+        result = [ None ]
+        def call():
+            result[0] = func(*args)
+            done.set()
+        self.Post(call)
+        done.wait()
+        return result[0]
+
+    def Write(self, text):
+        self.events.put((None, text))
+
+    def DrainEvents(self):
+        text = [ ]
+        for _ in range(1000): # Bounded, so a flood of events can't starve the window
             try:
-                self.after[name]()
-            except TestFailCritical as e:
-                self.test_icon_canvases[name].itemconfig(self.test_icon_images[name], image = self.img_fail)
-                self.textbox.insert(tk.END, "-> Result: CRITICAL FAILURE!\n")
-                self.textbox.insert(tk.END, f"Reason: {e}\n\n")
-                critical = True
-                self.errors += 1
-                self.critical = True
+                (func, args) = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if func is None:
+                text.append(args) # Consecutive text is inserted in one go
+                continue
+            if text:
+                self.textbox.insert(tk.END, ''.join(text))
+                text = [ ]
+            func(*args)
+        if text:
+            self.textbox.insert(tk.END, ''.join(text))
+            self.TrimTextbox()
+            self.textbox.see(tk.END)
+        self.window.after(self.refresh_ms, self.DrainEvents)
+
+    def TrimTextbox(self):
+        lines = int(self.textbox.index('end-1c').split('.')[0])
+        if lines > self.max_lines:
+            self.textbox.delete('1.0', f'{lines - self.max_lines + 1}.0')
+
+    def SetIcon(self, name, image):
+        self.Post(lambda: self.test_icon_canvases[name].itemconfig(self.test_icon_images[name], image = image))
+
+    def SetStat(self, name, value):
+        self.Post(self.stats.set, name, value)
+
+    def SetProgress(self, index, val):
+        self.progress[index]['value'] = val
+
+    def ShowError(self, title, msg):
+        self.Call(messagebox.showerror, title, msg)
+
+    # What the BoardRunner shows on the window
+    def write(self, text):
+        self.Write(text)
+        self.logsink.write(text)
+
+    def WriteRecord(self, text):
+        """A log record, formatted: to the board log and the textbox. It reaches the disk log by itself."""
+        self.runner.log_text.append(text)
+        self.Write(text)
+
+    def set_icon(self, name, passed):
+        self.SetIcon(name, self.img_pass if passed else self.img_fail)
+
+    def set_stat(self, name, value):
+        self.SetStat(name, value)
+
+    def set_progress(self, index, val):
+        self.Post(self.SetProgress, index, val)
+
+    def show_error(self, title, msg):
+        self.ShowError(title, msg)
 
-        self.textbox.see(tk.END)
-        self.window.update()
-        return critical
+    def StartButtonClick(self, param):
+        # The button is only disabled visually; clicks and <Return> still arrive while running
+        if self.worker and self.worker.is_alive():
+            return
+        self.window.after(10, self.ExecuteTests)
 
     def ExecuteTests(self):
-        self.start_time = time.time()
         self.start_button.configure(state = 'disabled')
         self.progress[0]['value'] = 0
         self.progress[1]['value'] = 0
         self.progress[2]['value'] = 0
         self.progress[3]['value'] = 0
         self.textbox.delete(1.0, tk.END)
-        self.window.update()
 
         self.serial = self.serial_entry.get()
+        self.rerun_failed = self.rerun_failed_var.get() != 0
         if len(self.serial) == 0:
             messagebox.showerror("Serial #", "No serial number given!")
             self.start_button.configure(state = 'normal')
             return
 
-        if not hasattr(self.testsuite, 'dut'):
-            try:
-                self.testsuite.startup()
-            except UsbToolsError as e:
-                messagebox.showerror("Failure!", f"Could not find JTAG cable.\n{e}")
-                self.start_button.configure(state = 'normal')
-                return
-            except JtagClientException as e:
-                messagebox.showerror("Failure!", f"Could not communicate with board.\n{e}\nCheck if it is powered.\nCheck the USB connection.")
-                self.start_button.configure(state = 'normal')
-                return
-
-        self.errors = 0
-        self.flashed = "No"
-        self.boot_ok = False
-        self.critical = False
-        self.failed_tests = [ ]
-        self.testsuite.reset_variables()
-        self.testsuite.serial = self.serial
-
         for name, _ in self.functions.items():
             self.test_icon_canvases[name].itemconfig(self.test_icon_images[name], image = self.img_err)
 
         self.stats.clear()
         self.stats.set('Serial #', self.serial)
         self.serial_entry.delete(0, tk.END)
-        self.window.update()
-
-        for name in self.functions:
-            if "test" in name:
-                if True: #not self.test_skip[name].get():
-                    if self.RunOneTest(name): # Returns 'true' when a critical error occurred (could also have re-raised)
-                        break
-
-        #try:
-        #    _res,frame = self.capture.read()
-        #    cv2.imwrite(f"images/{self.serial}.png", frame)
-        #except Exception as e:
-        #    self.textbox.insert(tk.END, str(e))
-
-        # If all tests are successful, the board can be flashed
-        if self.errors == 0: ## zero!
-            self.testsuite.program_flash([self.FlashUpdateFPGA, self.FlashUpdateAppl, self.FlashUpdateFAT])
-            self.flashed = "Yes"
-
-            self.boot_ok = self.testsuite.late_099_boot()
-            self.testsuite.dut_off()            
-            if not self.boot_ok:
-                self.test_icon_canvases[name].itemconfig(self.test_icon_images[name], image = self.img_fail)
-                self.textbox.insert(tk.END, "\n!!! BOARD DOESN'T BOOT !!!\n\n")
-                self.save_log()
-                messagebox.showerror("Reject", "Board doesn't boot correctly after Flashing.")
-            else:
-                self.test_icon_canvases[name].itemconfig(self.test_icon_images[name], image = self.img_pass)
-                self.textbox.insert(tk.END, "\n*** BOARD SUCCESSFULLY TESTED AND PROGRAMMED! ***\n\n")
-                self.save_log()
-        else:
-            self.textbox.insert(tk.END, "\n*** Board has not been programmed due to errors. ***\n\n")
-            self.save_log()
-            self.testsuite.dut_off()            
-            messagebox.showerror("Reject", "Board has not been programmed due to errors.")
-
-        self.testsuite.dut_off()            
-        self.end_time = time.time()
-        self.textbox.insert(tk.END, f"\nElapsed time: {self.end_time - self.start_time:.1f} sec.\n")
-        self.textbox.see(tk.END)
-        self.window.update()
 
-        try:
-            self.write_test_to_db()
-        except Exception as e:
-            messagebox.showerror("Database Error", str(e))
-            
-        self.start_button.configure(state = 'normal')
+        self.worker = threading.Thread(target = self.RunTests, daemon = True)
+        self.worker.start()
 
-    def setup(self):
+    def RunTests(self):
+        """The test flow; runs on the worker thread."""
+        try:
+            if self.probe:
+                self.probe.join()
+            self.runner.run(self.serial, self.rerun_failed)
+        finally:
+            self.Post(self.start_button.configure, { 'state': 'normal' })
+
+    def setup(self, welcome = True, probe = True):
+        from PIL import ImageTk, Image
         self.window=tk.Tk()
         self.window.title('Ultimate-64-II Factory Tester')
         self.img_logo = ImageTk.PhotoImage(Image.open("logo.jpg"))
@@ -296,6 +318,9 @@ class MyGui:
         tk.Label(self.serial_frame, text = "Serial #:").grid(column = 0, row = 0)
         self.serial_entry = tk.Entry(self.serial_frame)
         self.serial_entry.grid(column = 1, row = 0)
+        self.rerun_failed_var = tk.IntVar()
+        tk.Checkbutton(self.serial_frame, text = "Rerun failed tests only", variable = self.rerun_failed_var).grid(
+            column = 0, row = 1, columnspan = 2, sticky = tk.W)
         self.serial_frame.grid(column = 1, row = 3)
 
         self.start_button = tk.Button(self.window, text="Start!", font=("Liberation Serif", 16))
@@ -326,19 +351,27 @@ class MyGui:
         self.stats = InfoFields(self.window, ["Serial #", "FPGA ID", "Flash ID", "Board Revision", "Supply", "+5.0V", "+3.3V", "+1.8V",
                                               "+1.0V", "Vaux", "Vusb" ], 1, 1, 14, 20)
 
-        ch = TextboxLogHandler(self.textbox)
-        ch.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(message)s'))
-        Ultimate64IITests.add_log_handler(ch)
-        JtagClient.add_log_handler(ch)
+        self.logsink = LogSink(self.WriteRecord)
+        self.logsink.start()
+        for handler in self.logsink.handlers:
+            Ultimate64IITests.add_log_handler(handler)
+            JtagClient.add_log_handler(handler)
+
+        if probe:
+            self.probe = threading.Thread(target = self.ProbeCable, daemon = True)
+            self.probe.start()
 
         welcome_msg = "Welcome to the U64-II Tester.\n1) Attach test harness to board set\n2) Turn on the board\n3) Scan Serial Number\n4) Click 'start!'\n"
+        if welcome:
+            self.git_ready.wait(5)
         welcome_msg += "\nGIT VERSION: " + self.gitsha[1:10] + "\n"
-        messagebox.showinfo("Welcome!", welcome_msg)
+        if welcome:
+            messagebox.showinfo("Welcome!", welcome_msg)
 
         self.textbox.insert(tk.END, welcome_msg)
         self.textbox.see(tk.END)
         self.serial_entry.focus()
-        self.window.update()
+        self.window.after(self.refresh_ms, self.DrainEvents)
         #self.textbox.insert(tk.END, "Opening Video capture device\n")
         #self.window.update()
         #self.capture = cv2.VideoCapture(0)
@@ -347,85 +380,39 @@ class MyGui:
 
     def run(self):
         self.window.mainloop()
-
-    def UpdateVoltages(self):
-        self.stats.set('Supply', self.testsuite.voltages[0])
-        self.stats.set('Vaux', self.testsuite.voltages[1])
-        self.stats.set('+5.0V', self.testsuite.voltages[2])
-        self.stats.set('+3.3V', self.testsuite.voltages[3])
-        self.stats.set('+1.8V', self.testsuite.voltages[4])
-        self.stats.set('+1.0V', self.testsuite.voltages[5])
-        self.stats.set('Vusb', self.testsuite.voltages[6])
-
-    def UpdateUniqueId(self):
-        fpga_id_string = f'{self.testsuite.unique:016X}'
-        self.stats.set('FPGA ID', fpga_id_string)
-        return # TODO
-        serial_from_id = self.db.get_serial(fpga_id_string)
-        if serial_from_id:
-            if serial_from_id != self.serial:
-                msg = f"FPGA ID {fpga_id_string} was previously associated with Serial Number {serial_from_id}!"
-                messagebox.showerror("Wrong FPGA ID", msg)
-                raise TestFailCritical(msg)
-
-        board = self.db.get_board(self.serial)
-        if board:
-            if 'fpga_id' in board:
-                if board['fpga_id'] != fpga_id_string:
-                    msg = f"Serial Number {self.serial} has already been used for a board with FPGA ID {board['fpga_id']}!"
-                    messagebox.showerror("Wrong Serial #", msg)
-                    raise TestFailCritical(msg)
-
-    def UpdateBoardRevision(self):
-        self.stats.set('Board Revision', f'{self.testsuite.revision}')
-        self.stats.set('Flash ID', f'{self.testsuite.flashid:016X}')
-        if self.testsuite.revision == 16:
-            self.testsuite.proto = True
-            self.errors -= 1
-            # Rerun test!
-            self.RunOneTest('test_001_regulators')
-
-    def save_log(self):
-        with open(f"logs/{self.serial}.txt", "a") as logfile:
-            logfile.write(self.textbox.get("1.0", "end-1c"))
-
-    def write_test_to_db(self):
-        # Write board to board table
-        if self.testsuite.unique != 0 and self.testsuite.flashid != 0:
-            self.db.add_board({
-                'serial': self.serial,
-                'fpga_id': f'{self.testsuite.unique:016X}',
-                'flash_id': f'{self.testsuite.flashid:016X}',
-                'board_rev': self.testsuite.revision,
-            })
-
-        time = datetime.now().strftime("%Y-%m-%d, %H:%M:%S")
-
-        # Write statistiscs to stats table
-        self.db.add_test_results({
-            'serial': self.serial,
-            'flash_id': f'{self.testsuite.flashid:016X}',
-            'fpga_id': f'{self.testsuite.unique:016X}',
-            'date': time,
-            'vbus': self.testsuite.voltages[0][:-2],
-            'vaux': self.testsuite.voltages[1][:-2],
-            'vusb': self.testsuite.voltages[6][:-2],
-            'v50': self.testsuite.voltages[2][:-2],
-            'v33': self.testsuite.voltages[3][:-2],
-            'v18': self.testsuite.voltages[4][:-2],
-            'v10': self.testsuite.voltages[5][:-2],
-            'git': self.gitsha,
-            'flashed': self.flashed,
-            'booted' : self.boot_ok,
-            'critical': self.critical,
-            'failed': ','.join(self.failed_tests),
-        })
-
-        self.db.add_log({'serial' : self.serial,
-                         'date': time,
-                         'log': self.textbox.get("1.0", tk.END) })
+        self.logsink.stop()
+
+def startup_benchmark():
+    """Measures the time until the window takes input; without database, cable or welcome dialog."""
+    imported = time.perf_counter()
+    loaded = [ heavy for heavy in [ 'boto3', 'git', 'numpy', 'pyftdi', 'PIL' ] if heavy in sys.modules ]
+    gui = MyGui(connect = False)
+    gui.setup(welcome = False, probe = False)
+    def interactive():
+        now = time.perf_counter()
+        print(f"Imports:             {1000 * (imported - startup_time):7.1f} ms")
+        print(f"Time to interactive: {1000 * (now - startup_time):7.1f} ms")
+        for heavy in loaded:
+            print(f"Warning: {heavy} is imported with the gui module")
+        gui.window.destroy()
+    gui.window.after_idle(interactive)
+    gui.run()
 
 if __name__ == '__main__':
-    gui = MyGui()
+    if '--startup-benchmark' in sys.argv:
+        startup_benchmark()
+        exit()
+    config = None
+    if '--plan' in sys.argv:
+        config = PlanConfig.load(sys.argv[sys.argv.index('--plan') + 1])
+    # Throughput metrics in the Prometheus text format: --metrics-file <file> and / or --metrics-port <port>
+    exporter = None
+    if '--metrics-file' in sys.argv or '--metrics-port' in sys.argv:
+        filename = sys.argv[sys.argv.index('--metrics-file') + 1] if '--metrics-file' in sys.argv else None
+        port = int(sys.argv[sys.argv.index('--metrics-port') + 1]) if '--metrics-port' in sys.argv else None
+        exporter = MetricsExporter(Metrics(), filename, port).start()
+    gui = MyGui(config = config, metrics = exporter.metrics if exporter else None)
     gui.setup()
     gui.run()
+    if exporter:
+        exporter.stop()
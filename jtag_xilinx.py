@@ -1,5 +1,3 @@
-from pyftdi.jtag import *
-from pyftdi.ftdi import *
 import time
 import logging
 import struct
@@ -12,16 +10,19 @@ logger.setLevel(logging.DEBUG)
 ch = logging.StreamHandler()
 ch.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
 
+from jtaglock import PriorityLock, atomic
+from registers import Mailbox, MAILBOX_START, MAILBOX_END
+from registers import PROG_SOURCE, TESTER_PARAM, PROG_PROGRESS, PROG_LENGTH, PROG_LOCATION, DUT_TO_TESTER, TESTER_TO_DUT
+from registers import TEST_STATUS, VOLTAGES, SERIAL_NUMBER
+
 PROG_BUFFER     = 0x1000000
-PROG_SOURCE     = 0x0080
-TESTER_PARAM    = 0x0084
-PROG_PROGRESS   = 0x0088
-PROG_LENGTH     = 0x008C
-PROG_LOCATION   = 0x0090
-DUT_TO_TESTER   = 0x0094
-TESTER_TO_DUT	= 0x0098
-TEST_STATUS		= 0x009C
-SERIAL_NUMBER   = 0x00B0
+
+# A status poll reads the whole mailbox in one transaction, so it also checks the shadow of the host registers
+STATUS_BLOCK    = MAILBOX_START
+STATUS_LENGTH   = MAILBOX_END - MAILBOX_START
+
+# Polls the DUT gets to complete a command after it printed a fatal line, before the tester gives up on it
+FATAL_GRACE     = 5
 
 XILINX_USER1    = 0x02
 XILINX_USER2    = 0x03
@@ -37,26 +38,76 @@ XILINX_CFG_IN   = 0x05
 XILINX_CFG_OUT  = 0x04
 XILINX_FUSE_DNA = 0x32
 XILINX_FUSE_DNA2 = 0x17
+XILINX_BYPASS   = 0x3F
+
+# Several FPGAs on one chain; all are 7-series devices with a 6 bit instruction register
+IR_LENGTH       = 6
+CHAIN_MAX       = 16
+CFG_IN_DELAY    = 32 # Bits by which a device in CFG_IN delays the data it passes on, at most
+
+# pyftdi is only imported when the first client is created, which keeps importing this module cheap
+JtagEngine = JtagTool = BitSequence = Ftdi = None
+
+def load_pyftdi():
+    global JtagEngine, JtagTool, BitSequence, Ftdi
+    if JtagEngine is None:
+        from pyftdi.jtag import JtagEngine, JtagTool, BitSequence
+        from pyftdi.ftdi import Ftdi
 
 class JtagClientException(Exception):
     pass
 
+class DutTimeoutException(Exception):
+    """The DUT did not finish a command in time. The cable is fine, so this is not a JtagClientException."""
+    pass
+
 class JtagClient:
     def __init__(self, url = 'ftdi://ftdi:232h/0'):
         self.url = url
+        load_pyftdi()
         self.jtag = JtagEngine(trst=False, frequency=3e6)
         self.tool = JtagTool(self.jtag)
         self.jtag.configure(url)
         self.jtag.reset()
+        self.init_state()
+
+    def init_state(self):
+        """The state of the client that does not depend on the cable."""
         self._reverse = None
         self.file_size = [0, 0, 0, 0]
         self.flash_callback = [None, None, None, None]
+        self.images = { } # Preloaded binaries, by file name
+        self.telemetry = None # Receives the voltages of every status poll
+        self.chain = None # IDCODE per position on the chain, after scan_chain()
+        self.lock = PriorityLock() # Operations marked @atomic hold it; see priority()
+        self.settle_scale = 1.0 # Of the time the DUT hardware needs to settle; 0 on a simulated DUT
+        self.mailbox = Mailbox(self)
+        self.reset_stats()
+
+    def reset_stats(self):
+        # Transaction counters, for the run records
+        self.stats = { 'ir_selects': 0, 'round_trips': 0, 'bytes_written': 0, 'bytes_read': 0, 'mailbox_writes': 0 }
+
+    def settle(self, seconds):
+        """Waits for the DUT hardware, e.g. after a reset."""
+        if self.settle_scale:
+            time.sleep(seconds * self.settle_scale)
+
+    def priority(self, level):
+        """The operations of the calling thread in the with block go ahead of, or after, those of other threads:
+        jtaglock.HIGH for the test flow, LOW for background polling."""
+        return self.lock.priority(level)
+
+    def set_priority(self, level):
+        self.lock.set_priority(level)
 
     @staticmethod
     def add_log_handler(ch):
         global logger
-        logger.addHandler(ch)
+        if ch not in logger.handlers:
+            logger.addHandler(ch)
 
+    @atomic
     def jtag_clocks(self, clocks):
         cmd = bytearray(3)
         cnt = (clocks // 8) - 1
@@ -71,6 +122,18 @@ class JtagClient:
             cmd[1] = cnt
             self.jtag._ctrl._stack_cmd(cmd[0:2])
         
+    @atomic
+    def resync(self):
+        """Brings the cable and the TAP back to a known state after a communication error."""
+        self.jtag._ctrl._ftdi.purge_buffers()
+        self.jtag.reset()
+        self.jtag.sync()
+        self.mailbox.invalidate()
+        idcode = self.xilinx_read_id()
+        if idcode in (0, 0xFFFFFFFF):
+            raise JtagClientException(f"No device on the JTAG chain after re-sync (IDCODE {idcode:08x}).")
+
+    @atomic
     def xilinx_read_id(self):
         self.jtag.reset()
         idcode = self.jtag.read_dr(32)
@@ -78,6 +141,7 @@ class JtagClient:
         logger.info(f"IDCODE (reset): {int(idcode):08x}")
         return int(idcode)
 
+    @atomic
     def xilinx_read_dna(self):
         self.jtag.reset()
         self.jtag.go_idle()
@@ -103,7 +167,9 @@ class JtagClient:
             result[i] = self._reverse[bytes[i]]
         return result
 
+    @atomic
     def xilinx_load_fpga(self, filename):
+        self.mailbox.invalidate()
 	    # Reset
         logger.info("reset..")
         self.jtag.reset()
@@ -140,7 +206,121 @@ class JtagClient:
                 buffer = fi.read()
                 fo.write(self.bitreverse(buffer))
 
+    # Several devices on one chain. Positions count from TDO: position 0 is the device whose data comes out first.
+    # Devices that are not addressed get BYPASS, which puts one bit in the data path.
+
+    def tap_reset(self):
+        self.jtag.reset()
+        self.jtag.go_idle()
+
+    def tap_ir(self, value, length):
+        self.jtag.write_ir(BitSequence(value, False, length))
+
+    def tap_dr(self, value, length):
+        """Shifts value through the data registers of the chain; returns what came out."""
+        self.jtag.change_state('shift_dr')
+        out = self.jtag.shift_and_update_register(BitSequence(value, False, length))
+        self.jtag.go_idle()
+        self.stats['round_trips'] += 1
+        return int(out)
+
+    def tap_stream(self, chunks):
+        """Shifts bytes, MSB first, through the data registers in one go, e.g. a bitstream."""
+        self.jtag.change_state('shift_dr')
+        for buffer in chunks:
+            olen = len(buffer)-1
+            cmd = bytearray((Ftdi.WRITE_BYTES_NVE_MSB, olen & 0xff, (olen >> 8) & 0xff))
+            cmd.extend(buffer)
+            self.jtag._ctrl._stack_cmd(cmd)
+            self.stats['bytes_written'] += len(buffer)
+        self.jtag.change_state('update_dr')
+        self.jtag.go_idle()
+
+    @atomic
+    def scan_chain(self):
+        """Reads the IDCODE of every device on the chain; a device without one shows as None."""
+        self.tap_reset()
+        bits = 32 * (CHAIN_MAX + 1)
+        out = self.tap_dr((1 << bits) - 1, bits) # The ones that come through mark the end
+        chain = [ ]
+        offset = 0
+        while offset + 32 <= bits and len(chain) <= CHAIN_MAX:
+            if not out >> offset & 1: # A device with only a bypass register
+                chain.append(None)
+                offset += 1
+                continue
+            idcode = (out >> offset) & 0xFFFFFFFF
+            if idcode == 0xFFFFFFFF:
+                break
+            chain.append(idcode)
+            offset += 32
+        if not chain or len(chain) > CHAIN_MAX:
+            raise JtagClientException("No sensible JTAG chain found.")
+        self.chain = chain
+        logger.info(f"JTAG chain: {', '.join('bypass' if i is None else f'{i:08x}' for i in chain)}")
+        return chain
+
+    def chain_ir(self, instruction, positions):
+        """Loads the instruction into the devices at positions, and BYPASS into the others."""
+        value = 0
+        for p in range(len(self.chain)):
+            value |= (instruction if p in positions else XILINX_BYPASS) << (IR_LENGTH * p)
+        self.tap_ir(value, IR_LENGTH * len(self.chain))
+
+    def chain_dr(self, position, value, bits):
+        """Shifts value through the data register of the device at position, with the others in BYPASS;
+        returns what the register held."""
+        out = self.tap_dr(value << position, bits + len(self.chain) - 1)
+        return (out >> position) & ((1 << bits) - 1)
+
+    @atomic
+    def chain_read_dna(self, position):
+        self.tap_reset()
+        self.chain_ir(XILINX_FUSE_DNA, [ position ])
+        dna = self.chain_dr(position, 0, 64)
+        logger.info(f"DNA CODE of device {position}: {dna:16x}")
+        return dna
+
+    @atomic
+    def chain_user_read_id(self, position):
+        """The user ID of the tester FPGA image in the device at position. This assumes the user JTAG logic takes
+        the selection of its register at Update-DR, as the devices in BYPASS before it shift in zeros first."""
+        self.chain_ir(XILINX_USER4, [ position ])
+        self.chain_dr(position, 0 << 1 | 1, 5) # Select user register 0
+        self.chain_ir(XILINX_USER4, [ position ])
+        # The first bit selects the data registers; the ID follows it
+        user_id = self.chain_dr(position, 0, 33) >> 1
+        logger.info(f"UserID of device {position}: {user_id:08x}")
+        return user_id
+
+    @atomic
+    def broadcast_load_fpga(self, filename, positions = None):
+        """Configures the FPGAs at positions (default: all) with one bitstream, streamed once. In CFG_IN each
+        device passes the data on to the next, a few bits later; the configuration logic finds the sync word at any
+        bit offset, so all of them take the same stream. Returns the user ID and DNA of each, read one by one."""
+        if self.chain is None:
+            self.scan_chain()
+        positions = list(range(len(self.chain))) if positions is None else list(positions)
+        self.mailbox.invalidate()
+        logger.info(f"Configuring devices {positions} at once..")
+        self.tap_reset()
+        self.chain_ir(XILINX_PROGRAM, positions)
+        self.tap_reset()
+        self.jtag_clocks(10000)
+        self.chain_ir(XILINX_CFG_IN, positions)
+        data = self.read_image(filename)
+        # Pad the end, so that the data gets through all the devices in front of the last one
+        chunks = [ data[i:i + 16384] for i in range(0, len(data), 16384) ]
+        if len(self.chain) > 1:
+            chunks.append(bytes(CFG_IN_DELAY // 8 * (len(self.chain) - 1)))
+        self.tap_stream(chunks)
+        self.chain_ir(XILINX_START, positions)
+        self.jtag_clocks(32)
+        return [ { 'position': p, 'idcode': self.chain[p], 'user_id': self.chain_user_read_id(p),
+                   'dna': self.chain_read_dna(p) } for p in positions ]
+
     def set_user_ir(self, ir):
+        self.stats['ir_selects'] += 1
         self.jtag.write_ir(BitSequence(XILINX_USER4, False, 6))
         
         self.jtag.write_dr(BitSequence(ir << 1 | 1, False, 5))
@@ -161,6 +341,7 @@ class JtagClient:
         inp = BitSequence(0, length = bits)
         return self.jtag.shift_register(inp)
 
+    @atomic
     def user_read_id(self):
         self.set_user_ir(0)
         user_id = int(self.read_user_data(32))
@@ -168,6 +349,7 @@ class JtagClient:
         logger.info(f"UserID: {user_id:08x}")
         return user_id
 
+    @atomic
     def user_get_inputs(self):
         self.set_user_ir(1)
         inputs = int(self.read_user_data(16))
@@ -175,14 +357,16 @@ class JtagClient:
         logger.info(f"Inputs: {inputs:04x}")
         return inputs
 
+    @atomic
     def user_set_outputs(self, value):
         self.set_user_ir(2)
         self.jtag.shift_and_update_register(BitSequence(value, False, 8))
         self.jtag.go_idle()
 
+    @atomic
     def read_fifo(self, expected, cmd = 4, stopOnEmpty = False, readAll = False):
         available = 0
-        readback = b''
+        readback = bytearray() # Appending to bytes would copy everything read so far, for each chunk
         while expected > 0:
             self.set_user_ir(cmd)
             available = int(self.read_user_data(8))
@@ -209,6 +393,8 @@ class JtagClient:
             self.jtag._ctrl._stack_cmd(jtagcmd)
             self.jtag._ctrl.sync()
             read_now = self.jtag._ctrl._ftdi.read_data_bytes(olen+1, 4)
+            self.stats['round_trips'] += 2 # available count + data
+            self.stats['bytes_read'] += len(read_now)
             #print(len(read_now), read_now)
 
             #read_now = self.jtag.shift_register(BitSequence(bytes_ = outbytes)).tobytes(msby = True)
@@ -216,8 +402,9 @@ class JtagClient:
             readback += read_now
 
         self.jtag.go_idle()
-        return readback
+        return bytes(readback)
 
+    @atomic
     def user_read_debug(self):
         self.set_user_ir(3)
         rb = self.jtag.shift_and_update_register(BitSequence(0, False, 32))
@@ -225,6 +412,7 @@ class JtagClient:
         self.jtag.go_idle()
         return int(rb)
     
+    @atomic
     def user_read_console(self, do_print = False):
         raw = self.read_fifo(expected = 1000, cmd = 10, stopOnEmpty = True)
         text = bytearray(len(raw))
@@ -237,6 +425,7 @@ class JtagClient:
                 logger.info(line.strip())
         return text
     
+    @atomic
     def user_read_console2(self, do_print = False):
         raw = self.read_fifo(expected = 1000, cmd = 11, stopOnEmpty = True)
         text = bytearray(len(raw))
@@ -249,24 +438,34 @@ class JtagClient:
             logger.info(text)
         return text
     
+    def preload_image(self, name):
+        with open(name, "rb") as fi:
+            self.images[name] = fi.read()
+
+    def read_image(self, name):
+        """Returns the contents of a binary; preloaded if possible, otherwise read from disk."""
+        data = self.images.get(name)
+        if data is None:
+            with open(name, "rb") as fi:
+                data = fi.read()
+        return data
+
     def user_upload(self, name, addr):
         bytes_read = 0
         checksum = 0
-        with open(name, "rb") as fi:
-            logger.info(f"Uploading {name} to address {addr:08x}")
-            while(True):
-                buffer = fi.read(16384)
-                if len(buffer) <= 0:
-                    break
-                bytes_read += len(buffer)
-                self.user_write_memory(addr, buffer + b'\x00\x00\x00\x00\x00\x00\x00\x00')
-                addr += 16384
-                #l4 = len(buffer) // 4
-                #for i in range(l4):
-                #    checksum += struct.unpack("<L", buffer[i*4:i*4+4])[0]
-
-            logger.info(f"Uploaded {bytes_read:06x} bytes.")
-            #logger.info(f"Checksum: {checksum & 0xFFFFFFFF:08x}")
+        data = self.read_image(name)
+        logger.info(f"Uploading {name} to address {addr:08x}")
+        for offset in range(0, len(data), 16384):
+            buffer = data[offset:offset + 16384]
+            bytes_read += len(buffer)
+            self.user_write_memory(addr, buffer + b'\x00\x00\x00\x00\x00\x00\x00\x00')
+            addr += 16384
+            #l4 = len(buffer) // 4
+            #for i in range(l4):
+            #    checksum += struct.unpack("<L", buffer[i*4:i*4+4])[0]
+
+        logger.info(f"Uploaded {bytes_read:06x} bytes.")
+        #logger.info(f"Checksum: {checksum & 0xFFFFFFFF:08x}")
 
         if bytes_read == 0:
             logger.error(f"Reading file {name} failed -> Can't upload to board.")
@@ -277,9 +476,10 @@ class JtagClient:
     def user_run_bare(self, name):
         """Uploads the application to the board, assuming that there is no bootloader present, and the CPU starts from address 0x0."""
         self.user_set_outputs(0x00) # Reset
+        self.mailbox.invalidate()
         _size = self.user_upload(name, 0x0)
         self.user_set_outputs(0x80) # Unreset
-        time.sleep(3)
+        self.settle(3)
         self.user_read_id()
         #with open(name+"rb", "wb") as fo:
         #    fo.write(self.user_read_memory(0x00, size))
@@ -289,6 +489,7 @@ class JtagClient:
         magic = struct.pack("<LL", addr, 0x1571babe)
         if reset:
             self.user_set_outputs(0x00) # Reset
+            self.mailbox.invalidate() # The application starts with a fresh mailbox
         self.user_write_memory(0xFFFFF0, b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00') # Clear magic for flashing
         self.user_write_memory(0xFFF8, magic)
         #print(f"{self.user_read_int32(0xFFF8):08x}")
@@ -297,6 +498,7 @@ class JtagClient:
             self.user_set_outputs(0x80) # Unreset
         return value
 
+    @atomic
     def user_write_memory(self, addr, buffer):
         addrbytes = struct.pack("<L", addr)
         command = bytearray([ addrbytes[0], 4, addrbytes[1], 5, addrbytes[2], 6, addrbytes[3], 7, 0x80, 0x01])
@@ -309,9 +511,13 @@ class JtagClient:
         cmd.extend(buffer)
         self.jtag._ctrl._stack_cmd(cmd)
         self.jtag.go_idle()
+        self.stats['bytes_written'] += len(buffer)
+        if addr < MAILBOX_END and addr + len(buffer) > MAILBOX_START:
+            self.mailbox.forget(addr, len(buffer))
     
+    @atomic
     def user_read_memory(self, addr, len):
-        result = b''
+        result = bytearray()
         #logger.info(f"Reading {len} bytes from address {addr:08x}...")
         len //= 4
         #start_time = time.perf_counter()
@@ -335,7 +541,7 @@ class JtagClient:
         #execution_time = end_time - start_time
         #logger.info(f"Execution time: {execution_time:.3f} seconds")
 
-        return result
+        return bytes(result)
 
     def user_write_int32(self, addr, value):
         self.user_write_memory(addr, struct.pack("<L", value))
@@ -344,6 +550,18 @@ class JtagClient:
         valbytes = self.user_read_memory(addr, 4)
         return struct.unpack("<L", valbytes)[0]
 
+    @atomic
+    def poll_status(self):
+        """Returns (TESTER_TO_DUT, PROG_PROGRESS). The voltages come along for free and go to the telemetry."""
+        block = self.user_read_memory(STATUS_BLOCK, STATUS_LENGTH)
+        self.mailbox.verify(STATUS_BLOCK, block)
+        (progress, ) = struct.unpack_from("<L", block, PROG_PROGRESS - STATUS_BLOCK)
+        (command, ) = struct.unpack_from("<L", block, TESTER_TO_DUT - STATUS_BLOCK)
+        if self.telemetry:
+            self.telemetry.add(struct.unpack_from("<7H", block, VOLTAGES - STATUS_BLOCK))
+        return (command, progress)
+
+    @atomic
     def user_write_io(self, addr, bytes):
         addrbytes = struct.pack("<L", addr)
         command = struct.pack("<BBBBBB", addrbytes[0], 4, addrbytes[1], 5, addrbytes[2], 6)
@@ -353,6 +571,7 @@ class JtagClient:
         self.jtag.shift_and_update_register(BitSequence(bytes_ = command))
         self.jtag.go_idle()
 
+    @atomic
     def user_read_io(self, addr, len):
         addrbytes = struct.pack("<L", addr)
         command = struct.pack("<BBBBBB", addrbytes[0], 4, addrbytes[1], 5, addrbytes[2], 6)
@@ -375,28 +594,30 @@ class JtagClient:
         self.file_size[index] = os.stat(name).st_size
         logger.info(f"Size of file: {self.file_size[index]} bytes")
         self.user_upload(name, PROG_BUFFER + 4*1024*1024*index)
-        self.user_write_int32(PROG_LENGTH, int(self.file_size[index]))
-        self.user_write_int32(PROG_LOCATION, addr)
-        self.user_write_int32(PROG_SOURCE, PROG_BUFFER + 4*1024*1024*index)
+        # Written with the next command; the DUT may still be flashing the previous section
+        self.mailbox.set(PROG_LENGTH, int(self.file_size[index]))
+        self.mailbox.set(PROG_LOCATION, addr)
+        self.mailbox.set(PROG_SOURCE, PROG_BUFFER + 4*1024*1024*index)
         return self.user_read_int32(TESTER_TO_DUT)
 
     def xilinx_prog_flash_b(self, _index, command = 50):
-        self.user_write_int32(TESTER_TO_DUT, command)
+        self.mailbox.command(command)
         return self.user_read_int32(TESTER_TO_DUT)
     
     def xilinx_prog_flash_c(self, index, command = 50):
         max_time = 5*120 # 2 minutes
         pages = (self.file_size[index] + 255) // 256 #Callback for every page
 
-        while self.user_read_int32(TESTER_TO_DUT) == command and max_time > 0:
+        (status, progress) = self.poll_status()
+        while status == command and max_time > 0:
             time.sleep(.1)
+            (status, progress) = self.poll_status()
             if self.flash_callback[index]:
-                progress = 100 * self.user_read_int32(PROG_PROGRESS)
-                self.flash_callback[index](progress/pages)
+                self.flash_callback[index](100 * progress / pages)
             max_time -= 1
 
-        if self.user_read_int32(TESTER_TO_DUT) == command:
-            raise JtagClientException("Test did not complete in time.")
+        if status == command:
+            raise DutTimeoutException("Test did not complete in time.")
 
         if pages > 100: # avoid this for start of ESP32 (dirty hack)
             self.flash_callback[index](100.0)
@@ -416,44 +637,61 @@ class JtagClient:
         self.xilinx_prog_flash_c(index, 52)
 
     def start_test(self, test_id):
-        self.user_write_int32(TESTER_TO_DUT, test_id)
+        self.mailbox.command(test_id)
 
     def complete_test(self):
         if self.user_read_int32(TESTER_TO_DUT) != 0:
-            raise JtagClientException("Test did not complete in time.")
+            raise DutTimeoutException("Test did not complete in time.")
         result = self.user_read_int32(TEST_STATUS)
         return result
     
-    def perform_test(self, test_id, max_time = 10, log = False, param = None):
-        if isinstance(param, str):
-            self.user_write_int32(TESTER_PARAM, len(param))
-            bytes = param.encode("utf-8") + (b'\0' * 16)
-            self.user_write_memory(SERIAL_NUMBER, bytes)
-        elif param != None:
-            self.user_write_int32(TESTER_PARAM, param)
-        self.user_write_int32(TESTER_TO_DUT, test_id)
+    def perform_test(self, test_id, max_time = 10, log = False, param = None, scanner = None):
+        """Runs a test in the DUT application; returns (result, console text). When the scanner finds a fatal
+        signature in the console text, the DUT gets FATAL_GRACE more polls to complete the command; when it does
+        not, the result is None."""
+        with self.lock: # The parameters and the command go together
+            if isinstance(param, str):
+                self.mailbox.set(TESTER_PARAM, len(param))
+                self.mailbox.set(SERIAL_NUMBER, param.encode("utf-8") + (b'\0' * 16))
+            elif param != None:
+                self.mailbox.set(TESTER_PARAM, param)
+            self.mailbox.command(test_id)
         text = self.user_read_console(log)
-        while self.user_read_int32(TESTER_TO_DUT) == test_id and max_time > 0:
+        if scanner:
+            scanner.feed(text)
+        (status, _) = self.poll_status()
+        while status == test_id and max_time > 0:
+            if scanner and scanner.fatal:
+                max_time = min(max_time, FATAL_GRACE)
             time.sleep(.2)
-            text += self.user_read_console(log)
+            more = self.user_read_console(log)
+            if scanner:
+                scanner.feed(more)
+            text += more
+            (status, _) = self.poll_status()
             max_time -= 1
-        if self.user_read_int32(TESTER_TO_DUT) == test_id:
-            raise JtagClientException("Test did not complete in time.")
+        if status == test_id:
+            if scanner and scanner.fatal:
+                return (None, text)
+            raise DutTimeoutException("Test did not complete in time.")
         result = self.user_read_int32(TEST_STATUS)
         return (result, text)
 
     def reboot(self, test_id):
-        self.user_write_int32(TESTER_TO_DUT, test_id)
+        self.mailbox.command(test_id)
+        self.mailbox.invalidate()
         logger.info(f"ID before reboot: {self.user_read_id()}")
-        self.jtag.reset()
-        self.jtag.sync()
-        time.sleep(3.5)
-        self.jtag.reset()
-        self.jtag.sync()
+        with self.lock:
+            self.jtag.reset()
+            self.jtag.sync()
+        self.settle(3.5)
+        with self.lock:
+            self.jtag.reset()
+            self.jtag.sync()
         logger.info(f"ID after reboot: {self.user_read_id()}")
         text = ""
         for i in range(10): # 2 seconds
-            time.sleep(.2)
+            self.settle(.2)
             text += self.user_read_console(True)
         return text
 
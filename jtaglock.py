@@ -0,0 +1,78 @@
+import heapq
+import functools
+import itertools
+import threading
+from contextlib import contextmanager
+
+# Priorities of the users of a cable; a lower number goes first
+HIGH = 0 # The test flow: commands, uploads, flashing
+NORMAL = 1
+LOW = 2 # Background polling: console, voltages, progress
+
+class PriorityLock:
+    """Serializes the use of one cable. Reentrant, so a whole operation can hold it while it calls other
+    operations. When it is released, the waiter with the highest priority gets it; equal priorities go in
+    order of arrival. The priority is that of the waiting thread, see priority() and set_priority()."""
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.owner = None
+        self.depth = 0
+        self.waiting = [ ] # Heap of (priority, arrival, thread)
+        self.arrivals = itertools.count()
+        self.local = threading.local()
+
+    def acquire(self, priority = None):
+        me = threading.get_ident()
+        if priority is None:
+            priority = getattr(self.local, 'priority', NORMAL)
+        with self.cond:
+            if self.owner == me:
+                self.depth += 1
+                return
+            entry = (priority, next(self.arrivals), me)
+            heapq.heappush(self.waiting, entry)
+            while self.owner is not None or self.waiting[0] is not entry:
+                self.cond.wait()
+            heapq.heappop(self.waiting)
+            self.owner = me
+            self.depth = 1
+
+    def release(self):
+        with self.cond:
+            if self.owner != threading.get_ident():
+                raise RuntimeError("Cannot release a lock that is not held by this thread")
+            self.depth -= 1
+            if self.depth == 0:
+                self.owner = None
+                if self.waiting:
+                    self.cond.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def set_priority(self, priority):
+        """Sets the priority of the calling thread, for all its operations on the cable from now on."""
+        self.local.priority = priority
+
+    @contextmanager
+    def priority(self, priority):
+        """Runs the operations in the with block at the given priority."""
+        previous = getattr(self.local, 'priority', NORMAL)
+        self.local.priority = priority
+        try:
+            yield
+        finally:
+            self.local.priority = previous
+
+def atomic(method):
+    """Runs a cable operation as a whole: no other thread uses the cable until it returns, so the TAP and the
+    registers it selected stay as the operation left them."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
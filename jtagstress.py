@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+import sys
+import time
+import struct
+import random
+import argparse
+import threading
+from contextlib import contextmanager
+from simdut import SimulatedDut
+from jtaglock import HIGH, NORMAL, LOW
+
+# Many threads on one simulated cable: test flow threads write and read back their own memory as one
+# operation, at high priority; pollers read the status block and the console as fast as they can, at low
+# priority. Passes when no transaction was lost or interleaved, and the test flow was never kept waiting long.
+
+class NoLock:
+    """Stands in for the cable lock, to show what goes wrong without it."""
+    def acquire(self, priority = None):
+        pass
+
+    def release(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def set_priority(self, priority):
+        pass
+
+    @contextmanager
+    def priority(self, priority):
+        yield
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))] if values else 0.0
+
+class Stress:
+    def __init__(self, high, low, seconds, round_trip, priority = True, locked = True):
+        self.dut = SimulatedDut('sim://stress', round_trip = round_trip)
+        if not locked:
+            self.dut.lock = NoLock()
+        self.high = high
+        self.low = low
+        self.seconds = seconds
+        self.round_trip = round_trip
+        self.priority = priority
+        self.counts = [ ] # Transactions per thread
+        self.latency = { HIGH: [ ], LOW: [ ] }
+        self.mismatches = 0
+        self.lock = threading.Lock() # For the results of the threads
+
+    def test_flow(self, index, deadline):
+        self.dut.set_priority(HIGH if self.priority else NORMAL)
+        rng = random.Random(index)
+        addr = 0x100000 + 0x100 * index
+        (count, latency, bad, seq) = (0, [ ], 0, 0)
+        while time.perf_counter() < deadline:
+            seq += 1
+            data = struct.pack("<LL", index, seq)
+            start = time.perf_counter()
+            with self.dut.lock:
+                self.dut.user_write_memory(addr, data)
+                back = self.dut.user_read_memory(addr, 8)
+            latency.append(time.perf_counter() - start)
+            count += 2
+            if back != data:
+                bad += 1
+            time.sleep(rng.uniform(0, 4 * self.round_trip)) # The test flow does other things in between
+        with self.lock:
+            self.counts.append(count)
+            self.latency[HIGH] += latency
+            self.mismatches += bad
+
+    def poller(self, deadline):
+        self.dut.set_priority(LOW if self.priority else NORMAL)
+        (count, latency) = (0, [ ])
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            self.dut.poll_status()
+            latency.append(time.perf_counter() - start)
+            self.dut.user_read_console()
+            count += 2
+        with self.lock:
+            self.counts.append(count)
+            self.latency[LOW] += latency
+
+    def run(self):
+        deadline = time.perf_counter() + self.seconds
+        threads = [ threading.Thread(target = self.test_flow, args = (i, deadline)) for i in range(self.high) ]
+        threads += [ threading.Thread(target = self.poller, args = (deadline, )) for _ in range(self.low) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def check(self, bound):
+        """Prints the results; returns False when a transaction was lost or interleaved, or the bound was exceeded."""
+        stats = self.dut.stats
+        done = sum(self.counts)
+        lost = done - stats['round_trips']
+        high = self.latency[HIGH]
+        print(f"{done} transactions by {self.high} + {self.low} threads in {self.seconds} sec.; "
+              f"{lost} lost, {stats['interleaved']} interleaved, {self.mismatches} read back wrong")
+        for (name, values) in (('test flow', high), ('pollers', self.latency[LOW])):
+            print(f"  {name:10s} {len(values):7d} ops  p50 {1000 * percentile(values, 50):6.2f} ms  "
+                  f"p99 {1000 * percentile(values, 99):6.2f} ms  max {1000 * max(values, default = 0):6.2f} ms")
+        worst = percentile(high, 99)
+        print(f"  test flow p99 {1000 * worst:.2f} ms, bound {1000 * bound:.2f} ms: {'ok' if worst <= bound else 'EXCEEDED'}")
+        return lost == 0 and stats['interleaved'] == 0 and self.mismatches == 0 and worst <= bound
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Stress test of concurrent use of one cable, on a simulated DUT.')
+    parser.add_argument('--high', type = int, default = 2, help = 'test flow threads')
+    parser.add_argument('--low', type = int, default = 8, help = 'polling threads')
+    parser.add_argument('--seconds', type = float, default = 5)
+    parser.add_argument('--round-trip', type = float, default = 1.0, help = 'milliseconds per transaction')
+    parser.add_argument('--no-priority', action = 'store_true', help = 'all threads at the same priority')
+    parser.add_argument('--unlocked', action = 'store_true', help = 'without the lock; should fail')
+    args = parser.parse_args()
+
+    round_trip = args.round_trip / 1000
+    stress = Stress(args.high, args.low, args.seconds, round_trip, not args.no_priority, not args.unlocked)
+    stress.run()
+    # The test flow waits at most for the operation in progress, and for those of the other test flow threads
+    bound = (2 * args.high + 2) * round_trip * 1.5 + 0.005
+    exit(0 if stress.check(bound) else 1)
@@ -0,0 +1,116 @@
+import os
+import zlib
+import codecs
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# DynamoDB items are limited to 400 KB; keep each chunk well below that, leaving room for the other attributes
+CHUNK_SIZE = 300 * 1024
+
+def compress(data):
+    """Compresses bytes with zstd when available, otherwise with zlib. Returns (codec, compressed bytes)."""
+    if zstandard:
+        return ('zstd', zstandard.ZstdCompressor(level = 10).compress(data))
+    return ('zlib', zlib.compress(data, 9))
+
+def decompressor(codec):
+    if codec == 'zstd':
+        if not zstandard:
+            raise ValueError("Log is zstd compressed, but the zstandard module is not installed.")
+        return zstandard.ZstdDecompressor().decompressobj()
+    if codec == 'zlib':
+        return zlib.decompressobj()
+    raise ValueError(f"Unknown log codec '{codec}'")
+
+def chunk_date(date, index):
+    # The first chunk keeps the plain date, so single-chunk logs look like they always did
+    return date if index == 0 else f'{date}#{index:03d}'
+
+class LogStore:
+    """Stores compressed logs in the u64ii_logs table, split in ordered chunks when needed."""
+    def __init__(self, db, chunk_size = CHUNK_SIZE):
+        self.db = db
+        self.chunk_size = chunk_size
+
+    def upload(self, serial, date, text):
+        raw = text.encode('utf-8')
+        (codec, data) = compress(raw)
+        chunks = [ data[i:i + self.chunk_size] for i in range(0, len(data), self.chunk_size) ] or [ b'' ]
+        for index, chunk in enumerate(chunks):
+            self.db.add_log({'serial': serial,
+                             'date': chunk_date(date, index),
+                             'codec': codec,
+                             'chunk': index,
+                             'chunks': len(chunks),
+                             'size': len(raw), # Bytes of the uncompressed log
+                             'log': chunk })
+
+    def headers(self, serial):
+        from boto3.dynamodb.conditions import Key
+        # 'date' is a reserved word in DynamoDB expressions, hence the attribute name placeholders
+        return self.db.query(self.db.u64ii_logs, KeyConditionExpression = Key('serial').eq(serial),
+                             ProjectionExpression = '#d, chunk', ExpressionAttributeNames = { '#d': 'date' })
+
+    def stream(self, serial):
+        """Yields (date, text) pieces of all logs of a board, oldest first, decompressing chunk by chunk."""
+        # Only the small chunk headers are kept in memory; log data is fetched again per chunk
+        runs = { }
+        for item in self.headers(serial):
+            date = item['date'].split('#')[0]
+            runs.setdefault(date, []).append((int(item.get('chunk', 0)), item['date']))
+
+        for date in sorted(runs):
+            decomp = None
+            # A character may be split over two chunks, so the text is decoded across them
+            decoder = codecs.getincrementaldecoder('utf-8')(errors = 'replace')
+            for (_index, key) in sorted(runs[date]):
+                item = self.db.u64ii_logs.get_item(Key = { 'serial': serial, 'date': key })['Item']
+                if 'codec' not in item: # Uncompressed log, from before chunking
+                    yield (date, item['log'])
+                    continue
+                if not decomp:
+                    decomp = decompressor(item['codec'])
+                data = item['log']
+                data = getattr(data, 'value', data) # boto3 wraps binary attributes
+                yield (date, decoder.decode(decomp.decompress(bytes(data))))
+            if decomp:
+                tail = decoder.decode(decomp.flush(), final = True)
+                if tail:
+                    yield (date, tail)
+
+class LocalLog:
+    """Log file in the logs directory, to which only the text not yet written is appended."""
+    def __init__(self, serial, directory = 'logs', max_bytes = 4 * 1024 * 1024, backups = 5):
+        self.filename = os.path.join(directory, f'{serial}.txt')
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.written = 0
+
+    def rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            src = f'{self.filename}.{i}'
+            if os.path.exists(src):
+                os.replace(src, f'{self.filename}.{i + 1}')
+        os.replace(self.filename, f'{self.filename}.1')
+
+    def write(self, text):
+        """Appends the part of text beyond what was written before. Text is expected to only grow."""
+        new = text[self.written:]
+        if not new:
+            return
+        if os.path.exists(self.filename) and os.path.getsize(self.filename) + len(new) > self.max_bytes:
+            self.rotate()
+        with open(self.filename, "a") as logfile:
+            logfile.write(new)
+        self.written = len(text)
+
+if __name__ == '__main__':
+    import sys
+    from db import Database
+    store = LogStore(Database())
+    for serial in sys.argv[1:]:
+        for (date, text) in store.stream(serial):
+            sys.stdout.write(text)
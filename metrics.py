@@ -0,0 +1,157 @@
+import os
+import time
+import bisect
+import threading
+from collections import deque
+
+# Live throughput metrics of a station, in the Prometheus text format, from a file (for the node exporter's
+# textfile collector) or from http://127.0.0.1:<port>/metrics. The test thread only updates numbers in memory;
+# the text is made by the exporter thread.
+
+PREFIX = 'u64tester_'
+RATE_WINDOW = 3600 # Seconds over which boards per hour are counted
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    'boards_total': ('counter', 'Boards tested, by result', None),
+    'boards_per_hour': ('gauge', 'Boards finished in the last hour', None),
+    'board_seconds': ('histogram', 'Time per board, from start to the end of the boot check',
+                      (30, 60, 90, 120, 150, 180, 240, 300, 600)),
+    'test_seconds': ('histogram', 'Time per test step', (0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120)),
+    'flash_mbytes_per_second': ('histogram', 'Flash programming speed', (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 2)),
+    'jtag_round_trips': ('histogram', 'JTAG round trips per board', (1000, 2000, 5000, 10000, 20000, 50000, 100000)),
+    'db_write_seconds': ('histogram', 'Time to write the results of a board to the database', (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10)),
+    'queue_depth': ('gauge', 'Boards waiting for a station, and runners waiting to write to the database', None),
+}
+
+def label_text(labels):
+    if not labels:
+        return ''
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{escape(v)}"' for (k, v) in labels) + '}'
+
+class Metrics:
+    """Counters, gauges and histograms by name and labels. Updates hold the lock for a few microseconds."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = { } # (name, labels): number, or [ bucket counts, sum, count ] for histograms
+        self.finished = { } # station: deque of the times boards finished
+
+    def key(self, name, labels):
+        if name not in METRICS:
+            raise KeyError(f"Unknown metric '{name}'")
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, value = 1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.values[key] = value
+
+    def observe(self, name, value, **labels):
+        key = self.key(name, labels)
+        buckets = METRICS[name][2]
+        with self.lock:
+            h = self.values.get(key)
+            if h is None:
+                h = self.values[key] = [ [ 0 ] * len(buckets), 0.0, 0 ]
+            i = bisect.bisect_left(buckets, value)
+            if i < len(buckets):
+                h[0][i] += 1
+            h[1] += value
+            h[2] += 1
+
+    def board_done(self, station):
+        with self.lock:
+            self.finished.setdefault(station, deque()).append(time.time())
+
+    def render(self):
+        now = time.time()
+        with self.lock:
+            for (station, times) in self.finished.items():
+                while times and times[0] < now - RATE_WINDOW:
+                    times.popleft()
+                self.values[('boards_per_hour', (('station', station), ))] = len(times) * 3600 / RATE_WINDOW
+            values = { k: (v if not isinstance(v, list) else [ list(v[0]), v[1], v[2] ]) for (k, v) in self.values.items() }
+        lines = [ ]
+        for (name, (kind, help, buckets)) in METRICS.items():
+            series = sorted((labels, v) for ((n, labels), v) in values.items() if n == name)
+            if not series:
+                continue
+            lines.append(f'# HELP {PREFIX}{name} {help}')
+            lines.append(f'# TYPE {PREFIX}{name} {kind}')
+            for (labels, v) in series:
+                if kind != 'histogram':
+                    lines.append(f'{PREFIX}{name}{label_text(labels)} {v:g}')
+                    continue
+                (counts, total, count) = v
+                cumulative = 0
+                for (le, c) in zip(buckets, counts):
+                    cumulative += c
+                    lines.append(f'{PREFIX}{name}_bucket{label_text(labels + (("le", f"{le:g}"), ))} {cumulative}')
+                lines.append(f'{PREFIX}{name}_bucket{label_text(labels + (("le", "+Inf"), ))} {count}')
+                lines.append(f'{PREFIX}{name}_sum{label_text(labels)} {total:g}')
+                lines.append(f'{PREFIX}{name}_count{label_text(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+class MetricsExporter:
+    """Makes the metrics available, in a file that is rewritten every interval seconds, and / or on a local port."""
+    def __init__(self, metrics, filename = None, port = None, interval = 5):
+        self.metrics = metrics
+        self.filename = filename
+        self.port = port
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.server = None
+
+    def write_file(self):
+        # Replace the file as a whole, so a reader never sees half of it
+        tmpname = self.filename + '.tmp'
+        with open(tmpname, 'w') as f:
+            f.write(self.metrics.render())
+        os.replace(tmpname, self.filename)
+
+    def run_file(self):
+        while not self.stop_event.is_set():
+            try:
+                self.write_file()
+            except OSError as e:
+                print(f"Writing metrics to {self.filename} failed: {e}")
+            self.stop_event.wait(self.interval)
+
+    def start(self):
+        if self.filename:
+            threading.Thread(target = self.run_file, name = 'metrics-file', daemon = True).start()
+        if self.port:
+            from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+            metrics = self.metrics
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path not in ('/', '/metrics'):
+                        self.send_error(404)
+                        return
+                    body = metrics.render().encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+            self.server = ThreadingHTTPServer(('127.0.0.1', self.port), Handler)
+            self.server.daemon_threads = True
+            threading.Thread(target = self.server.serve_forever, name = 'metrics-http', daemon = True).start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        if self.filename:
+            self.write_file()
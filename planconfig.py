@@ -0,0 +1,48 @@
+import json
+import os
+
+# A test plan file sets which tests run and how long they may take, e.g. plans/full.json for normal
+# production and plans/fast.json when volume is high. All fields are optional:
+#   name            shown in the log and stored with the run
+#   target          seconds one board may take, from start to the end of the boot check
+#   test_all_mask   which tests the DUT application runs in TEST_ALL; a number, or a string like "0xFBFF"
+#   timeouts        seconds per test method that the DUT may take to complete
+#   ddr_depth       the DDR2 test writes at 1 << 6 .. 1 << (ddr_depth - 1)
+#   optional        '_test_*' methods to run as well
+#   budgets         seconds per test step (also 'program_flash', 'late_099_boot'), for the time report
+#   signatures      console text of the DUT as "fatal" or "pass", on top of CONSOLE_SIGNATURES; null drops one
+
+class PlanConfig:
+    def __init__(self, name = 'default', target = None, test_all_mask = 0xFFFF, timeouts = None, ddr_depth = 26,
+                 optional = (), budgets = None, signatures = None):
+        self.name = name
+        self.target = target
+        self.test_all_mask = int(test_all_mask, 0) if isinstance(test_all_mask, str) else test_all_mask
+        self.timeouts = timeouts or { }
+        self.ddr_depth = ddr_depth
+        self.optional = list(optional)
+        self.budgets = budgets or { }
+        self.signatures = signatures or { }
+
+    @staticmethod
+    def load(filename):
+        with open(filename, 'r') as f:
+            fields = json.load(f)
+        fields.setdefault('name', os.path.splitext(os.path.basename(filename))[0])
+        fields.pop('comment', None)
+        return PlanConfig(**fields)
+
+    def report(self, times, total):
+        """Measured time against budget per step. times is a list of (name, seconds)."""
+        lines = [ f"Plan '{self.name}': {total:.1f} sec." + (f" of {self.target:.0f} sec. target" if self.target else "") +
+                  (" -- OVER TARGET" if self.target and total > self.target else "") ]
+        for (name, seconds) in times:
+            budget = self.budgets.get(name)
+            if budget is None:
+                lines.append(f"  {seconds:6.2f}          {name}")
+            else:
+                lines.append(f"  {seconds:6.2f} /{budget:6.2f}  {name}" + (" -- OVER BUDGET" if seconds > budget else ""))
+        return '\n'.join(lines) + '\n'
+
+    def over_budget(self, times):
+        return [ name for (name, seconds) in times if name in self.budgets and seconds > self.budgets[name] ]
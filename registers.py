@@ -0,0 +1,141 @@
+import struct
+import logging
+
+logger = logging.getLogger('JTAG')
+
+# Mailbox between tester and the test application on the DUT
+PROG_SOURCE     = 0x0080
+TESTER_PARAM    = 0x0084
+PROG_PROGRESS   = 0x0088
+PROG_LENGTH     = 0x008C
+PROG_LOCATION   = 0x0090
+DUT_TO_TESTER   = 0x0094
+TESTER_TO_DUT	= 0x0098
+TEST_STATUS		= 0x009C
+VOLTAGES        = 0x00A0
+SERIAL_NUMBER   = 0x00B0
+
+HOST = 'host'   # only the tester writes it, so the tester knows its value
+DUT = 'dut'     # written by the DUT; never cached
+SHARED = 'shared'
+
+class Register:
+    def __init__(self, name, addr, owner = HOST, fmt = "<L"):
+        self.name = name
+        self.addr = addr
+        self.owner = owner
+        self.fmt = fmt # None for a byte string of any length
+
+    def pack(self, value):
+        if self.fmt is None:
+            return bytes(value)
+        return struct.pack(self.fmt, value)
+
+    def unpack(self, data):
+        if self.fmt is None:
+            return data
+        values = struct.unpack(self.fmt, data)
+        return values[0] if len(values) == 1 else values
+
+    @property
+    def size(self):
+        return struct.calcsize(self.fmt) if self.fmt else 0
+
+REGISTERS = [
+    Register('PROG_SOURCE', PROG_SOURCE),
+    Register('TESTER_PARAM', TESTER_PARAM),
+    Register('PROG_PROGRESS', PROG_PROGRESS, DUT),
+    Register('PROG_LENGTH', PROG_LENGTH),
+    Register('PROG_LOCATION', PROG_LOCATION),
+    Register('DUT_TO_TESTER', DUT_TO_TESTER, DUT),
+    Register('TESTER_TO_DUT', TESTER_TO_DUT, SHARED), # The DUT clears it when done
+    Register('TEST_STATUS', TEST_STATUS, DUT),
+    Register('VOLTAGES', VOLTAGES, DUT, "<8H"),
+    Register('SERIAL_NUMBER', SERIAL_NUMBER, HOST, None),
+]
+BY_ADDR = { r.addr: r for r in REGISTERS }
+MAILBOX_START = PROG_SOURCE
+MAILBOX_END = SERIAL_NUMBER + 0x40 # The serial number string is shorter than this
+
+class Mailbox:
+    """Host side of the mailbox. Writes to host registers are kept until the next command, skipped when the
+    DUT already has the value, and written in as few bursts as possible; the command goes last.
+    Only PROG_LENGTH and PROG_LOCATION are adjacent. TESTER_PARAM, SERIAL_NUMBER and TESTER_TO_DUT have DUT
+    registers in between, which the tester cannot write without clobbering them, so setting the serial number
+    still takes three writes; the saving is in the writes that are skipped. The writes are counted in the
+    'mailbox_writes' statistic of the client."""
+    def __init__(self, dut):
+        self.dut = dut
+        self.shadow = { } # addr -> bytes the DUT has, for host registers only
+        self.pending = { } # addr -> bytes to write
+
+    def invalidate(self):
+        """The DUT memory can no longer be trusted, e.g. after loading the FPGA or a reboot."""
+        self.shadow = { }
+
+    def forget(self, addr, length):
+        """Memory was written outside of the mailbox; drops what is known about the registers it covered."""
+        for a in [ a for a, data in self.shadow.items() if a < addr + length and addr < a + len(data) ]:
+            del self.shadow[a]
+
+    def verify(self, addr, block):
+        """Compares the shadow with mailbox memory read from addr. The DUT application is not supposed to write the
+        host registers; one that it did write is dropped from the shadow, so the next write to it is not skipped."""
+        for (a, data) in list(self.shadow.items()):
+            if block[a - addr:a - addr + len(data)] != data:
+                logger.warning(f"DUT changed mailbox register {BY_ADDR[a].name}; not trusting it.")
+                del self.shadow[a]
+
+    def set(self, addr, value):
+        reg = BY_ADDR[addr]
+        if reg.owner != HOST:
+            raise ValueError(f"Register {reg.name} is not owned by the tester")
+        data = reg.pack(value)
+        if self.shadow.get(addr) == data:
+            self.pending.pop(addr, None)
+        else:
+            self.pending[addr] = data
+
+    def get(self, addr, length = None):
+        reg = BY_ADDR[addr]
+        return reg.unpack(self.dut.user_read_memory(addr, length or reg.size))
+
+    def bursts(self):
+        """Joins the pending writes that are adjacent in memory into bursts of (addr, [ (addr, data), .. ]).
+        Known host registers in between are filled in from the shadow; DUT registers are never overwritten,
+        so they split bursts."""
+        bursts = [ ]
+        current = None # The parts of the burst being built
+        filler = [ ] # Unchanged registers, only written when a pending one follows
+        end = None
+        for reg in REGISTERS:
+            if current is not None and reg.addr != end:
+                (current, filler) = (None, [ ])
+            if reg.addr in self.pending:
+                if current is None:
+                    current = [ ]
+                    bursts.append(current)
+                current += filler + [ (reg.addr, self.pending[reg.addr]) ]
+                filler = [ ]
+                end = reg.addr + len(self.pending[reg.addr])
+            elif current is not None and reg.owner == HOST and reg.addr in self.shadow:
+                filler.append((reg.addr, self.shadow[reg.addr]))
+                end = reg.addr + len(self.shadow[reg.addr])
+            else:
+                (current, filler) = (None, [ ])
+        return [ (parts[0][0], parts) for parts in bursts ]
+
+    def flush(self):
+        with self.dut.lock:
+            for (addr, parts) in self.bursts():
+                self.dut.user_write_memory(addr, b''.join(data for (_, data) in parts))
+                self.dut.stats['mailbox_writes'] += 1
+                self.shadow.update(parts)
+            self.pending = { }
+
+    def command(self, value):
+        """Writes the pending registers, then the command to the DUT, without other users of the cable in between."""
+        with self.dut.lock:
+            self.flush()
+            self.dut.user_write_int32(TESTER_TO_DUT, value)
+            self.dut.stats['mailbox_writes'] += 1
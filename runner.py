@@ -0,0 +1,459 @@
+import time
+import threading
+from datetime import datetime
+from tests import Ultimate64IITests, TestFail, TestFailCritical, TestTimeout, JtagClientException, image_hashes, flash_bytes
+from logstore import LogStore, LocalLog
+from runrecord import RunRecordWriter
+from checkpoint import Checkpoint
+from planconfig import PlanConfig
+from jtaglock import HIGH
+
+class BoardRunner:
+    """The test flow of one board: tests, flashing, boot check, log and records. It runs without a window;
+    what the operator should see goes to the ui object, which implements:
+        write(text), set_icon(name, passed), set_stat(name, value), set_progress(index, value), show_error(title, msg)
+    All of these are called from the thread that runs the board."""
+    def __init__(self, ui, database = None, url = 'ftdi://ftdi:232h/0', records = None, lock = None, directory = 'logs',
+                 config = None, metrics = None):
+        self.ui = ui
+        self.database = database # Returns the Database; None to run without one
+        self.url = url
+        self.records = records or RunRecordWriter()
+        self.lock = lock or threading.Lock() # Serializes database and record writes of runners sharing them
+        self.gitsha = 'unknown'
+        self.directory = directory # Board logs and checkpoints
+        self.log_text = [ ]
+        self.config = config or PlanConfig() # Which tests run, their timeouts and time budgets
+        self.metrics = metrics # Throughput metrics of the station; None to keep none
+        self.collect_tests()
+
+    def collect_tests(self):
+        self.testsuite = Ultimate64IITests(self.config)
+        self.after = { }
+        functions = self.testsuite.get_all_tests()
+        self.functions = { }
+        for (name, func) in functions.items():
+            if func.__doc__:
+                self.functions[name] = (func, func.__doc__)
+            else:
+                self.functions[name] = (func, name.lstrip('_')[9:])
+
+        self.after['test_008_get_voltages'] = self.update_voltages
+        self.after['test_001_unique_id'] = self.update_unique_id
+        self.after['test_003_board_revision'] = self.update_board_revision
+        self.testsuite.esp_callback = lambda val: self.ui.set_progress(0, val)
+
+    def write(self, text):
+        self.log_text.append(text)
+        self.ui.write(text)
+
+    def startup(self):
+        """Opens the cable. Returns False, after telling the operator why, when that fails."""
+        try:
+            from pyftdi.usbtools import UsbToolsError
+        except ImportError: # Simulated boards do without pyftdi
+            UsbToolsError = OSError
+        if hasattr(self.testsuite, 'dut'):
+            return True
+        try:
+            self.testsuite.startup(self.url)
+        except UsbToolsError as e:
+            self.ui.show_error("Failure!", f"Could not find JTAG cable.\n{e}")
+            return False
+        except JtagClientException as e:
+            self.ui.show_error("Failure!", f"Could not communicate with board.\n{e}\nCheck if it is powered.\nCheck the USB connection.")
+            return False
+        return True
+
+    def run_host_step(self, step):
+        try:
+            step.func()
+        except Exception as e:
+            self.write(f"Host step '{step.name}' failed: {e}\n")
+
+    def resync_dut(self, e):
+        self.write(f"Communication error: {e}\nRe-synchronizing JTAG and retrying.\n")
+        try:
+            self.testsuite.dut.resync()
+            return True
+        except Exception as e2:
+            self.write(f"Re-sync failed: {e2}\n")
+            return False
+
+    def run_one_test(self, name):
+        (func, doc) = self.functions[name]
+        if self.resume and name in self.resume.passed and not getattr(func, 'setup', False):
+            self.ui.set_icon(name, True)
+            self.write(f"Skipping test '{doc}'; it passed in the previous run.\n\n")
+            self.results.append({ 'test': name, 'name': doc, 'result': 'skipped', 'reason': '', 'duration': 0.0 })
+            return False
+
+        self.write(f"Running test '{doc}'\n{'-' * (14 + len(doc))}\n")
+        self.testsuite.telemetry.phase(name)
+        critical = False
+        result = 'pass'
+        reason = ''
+        line = None
+        start = time.perf_counter()
+        retry = True
+        while retry:
+            retry = False
+            try:
+                critical = self.try_one_test(name, func)
+            except JtagClientException as e:
+                if self.comm_retries > 0 and self.resync_dut(e):
+                    self.comm_retries -= 1
+                    retry = True
+                    continue
+                # Stop this run; the checkpoint allows to continue with 'Rerun failed tests only'
+                self.ui.set_icon(name, False)
+                self.write("-> Result: COMMUNICATION ERROR!\n")
+                self.write(f"Reason: {e}\n\n")
+                critical = True
+                self.errors += 1
+                self.critical = True
+                self.comm_error = True
+                (result, reason) = ('comm', str(e))
+            except TestFailCritical as e:
+                (result, reason, line) = ('critical', str(e), e.line)
+                critical = True
+            except TestFail as e:
+                (result, reason, line) = ('fail', str(e), e.line)
+            except Exception as e:
+                (result, reason) = ('error', str(e))
+        self.results.append({ 'test': name, 'name': doc, 'result': result, 'reason': reason,
+                              'duration': round(time.perf_counter() - start, 3) })
+        if line:
+            self.results[-1]['console'] = line
+        if self.checkpoint:
+            self.checkpoint.record(name, result == 'pass', self.testsuite.get_values())
+
+        if name in self.after:
+            try:
+                self.after[name]()
+            except Exception as e:
+                # Whatever goes wrong in what follows a test, the run ends with a record of the board
+                self.ui.set_icon(name, False)
+                self.write("-> Result: CRITICAL FAILURE!\n" if isinstance(e, TestFailCritical) else "-> Result: ERROR!\n")
+                self.write(f"Reason: {e}\n\n")
+                critical = True
+                self.errors += 1
+                self.critical = True
+
+        return critical
+
+    def try_one_test(self, name, func):
+        """Runs a test and shows its result. Communication errors are passed on; test failures are re-raised
+        after being accounted for."""
+        critical = False
+        try:
+            func(self.testsuite)
+            self.ui.set_icon(name, True)
+            self.write("-> Result: OK!\n\n")
+        except TestFailCritical as e:
+            self.ui.set_icon(name, False)
+            self.write("-> Result: CRITICAL FAILURE!\n")
+            self.write(f"Reason: {e}\n\n")
+            if isinstance(e, TestTimeout):
+                self.failed_tests.append(name.lstrip('_')[5:8])
+            self.errors += 1
+            self.critical = True
+            raise
+        except TestFail as e:
+            self.ui.set_icon(name, False)
+            self.write("-> Result: FAIL!\n")
+            self.write(f"Reason: {e}\n\n")
+            self.failed_tests.append(name.lstrip('_')[5:8]) # Add number to list
+            self.errors += 1
+            raise
+        except JtagClientException:
+            raise
+        except Exception as e:
+            self.write("-> Result: ERROR!\n")
+            self.write(f"Reason: {e}\n\n")
+            self.critical = True
+            self.errors += 1
+            raise
+        return critical
+
+    def run(self, serial, rerun_failed = False):
+        """Tests, flashes and boots one board. Returns the summary of the run, or None when the cable
+        could not be opened."""
+        self.start_time = time.time()
+        self.serial = serial
+        self.log_text = [ ]
+        if not self.startup():
+            return None
+        self.testsuite.dut.set_priority(HIGH) # Background users of the cable wait for the test flow
+
+        self.errors = 0
+        self.flashed = "No"
+        self.boot_ok = False
+        self.critical = False
+        self.failed_tests = [ ]
+        self.results = [ ]
+        self.step_times = { }
+        self.comm_error = False
+        self.comm_retries = 3
+        self.testsuite.reset_variables()
+        self.testsuite.dut.reset_stats()
+        self.testsuite.serial = self.serial
+        self.logfile = LocalLog(self.serial, self.directory)
+
+        self.checkpoint = Checkpoint(self.serial, self.directory)
+        self.resume = None
+        if rerun_failed:
+            self.resume = Checkpoint.load(self.serial, self.directory)
+            if self.resume:
+                self.write(f"Rerunning failed tests only; {len(self.resume.passed)} tests passed before.\n\n")
+            else:
+                self.write("No previous run of this board found; running all tests.\n\n")
+
+        # DUT steps run here in order; host steps (preloading, hashing) overlap with them on other threads.
+        # run_one_test returns 'true' when a critical error occurred, which ends the DUT steps.
+        self.plan = self.testsuite.get_plan()
+        self.plan.run(lambda s: self.run_one_test(s.name), self.run_host_step)
+        name = 'late_099_boot' # Flashing and the boot check show on its icon
+
+        # If all tests are successful, the board can be flashed
+        if self.errors == 0: ## zero!
+            try:
+                self.testsuite.telemetry.phase('program_flash')
+                start = time.perf_counter()
+                self.testsuite.program_flash([ lambda val: self.ui.set_progress(1, val),
+                                               lambda val: self.ui.set_progress(2, val),
+                                               lambda val: self.ui.set_progress(3, val) ])
+                self.step_times['program_flash'] = time.perf_counter() - start
+                self.flashed = "Yes"
+
+                self.testsuite.telemetry.phase('late_099_boot')
+                start = time.perf_counter()
+                self.boot_ok = self.testsuite.late_099_boot()
+                self.step_times['late_099_boot'] = time.perf_counter() - start
+            except Exception as e:
+                self.write("\n!!! PROGRAMMING OR BOOT TEST FAILED !!!\n")
+                self.write(f"Reason: {e}\n\n")
+                self.errors += 1
+                self.critical = True
+                self.boot_ok = False
+            self.testsuite.dut_off()
+            if self.errors:
+                self.ui.set_icon(name, False)
+                self.save_log()
+                self.ui.show_error("Reject", "Programming the board failed.")
+            elif not self.boot_ok:
+                self.ui.set_icon(name, False)
+                self.write("\n!!! BOARD DOESN'T BOOT !!!\n\n")
+                self.save_log()
+                self.ui.show_error("Reject", "Board doesn't boot correctly after Flashing.")
+            else:
+                self.ui.set_icon(name, True)
+                self.write("\n*** BOARD SUCCESSFULLY TESTED AND PROGRAMMED! ***\n\n")
+                self.save_log()
+                self.checkpoint.remove()
+        elif self.comm_error:
+            self.write("\n*** Board has not been programmed due to a communication error. ***\n\n")
+            self.save_log()
+            self.ui.show_error("Communication Error", "Lost communication with the board.\nCheck the connection, then start again "
+                                                      "with 'Rerun failed tests only' to continue where the test stopped.")
+        else:
+            self.write("\n*** Board has not been programmed due to errors. ***\n\n")
+            self.save_log()
+            self.testsuite.dut_off()
+            self.ui.show_error("Reject", "Board has not been programmed due to errors.")
+
+        self.testsuite.dut_off()
+        self.end_time = time.time()
+        self.write(f"\nElapsed time: {self.end_time - self.start_time:.1f} sec.\n")
+        self.write(self.plan.report())
+        self.write(self.config.report(self.times(), self.end_time - self.start_time))
+        self.report_rails()
+
+        try:
+            self.write_run_record()
+        except Exception as e:
+            self.ui.show_error("Run Record Error", str(e))
+
+        if self.database:
+            try:
+                start = time.perf_counter()
+                self.write_test_to_db()
+                if self.metrics:
+                    self.metrics.observe('db_write_seconds', time.perf_counter() - start, station = self.url)
+            except Exception as e:
+                self.ui.show_error("Database Error", str(e))
+        if self.metrics:
+            self.update_metrics()
+        return self.summary()
+
+    def summary(self):
+        return {
+            'serial': self.serial,
+            'cable': self.url,
+            'passed': self.errors == 0 and self.boot_ok,
+            'errors': self.errors,
+            'critical': self.critical,
+            'comm_error': self.comm_error,
+            'flashed': self.flashed == "Yes",
+            'booted': self.boot_ok,
+            'failed': self.failed_tests,
+            'fpga_id': f'{self.testsuite.unique:016X}',
+            'flash_id': f'{self.testsuite.flashid:016X}',
+            'board_rev': self.testsuite.revision,
+            'voltages_mv': self.testsuite.voltages_mv,
+            'rail_violations': self.testsuite.telemetry.violations(),
+            'tests': self.results,
+            'elapsed': round(self.end_time - self.start_time, 3),
+            'plan': self.config.name,
+        }
+
+    def times(self):
+        """Measured time per step of this run, in the order they ran: (name, seconds)."""
+        times = [ (r['test'], r['duration']) for r in self.results if r['result'] != 'skipped' ]
+        return times + list(self.step_times.items())
+
+    def update_metrics(self):
+        m = self.metrics
+        m.inc('boards_total', station = self.url, result = 'pass' if self.errors == 0 and self.boot_ok else 'fail')
+        m.board_done(self.url)
+        m.observe('board_seconds', self.end_time - self.start_time, station = self.url)
+        for (name, seconds) in self.times():
+            m.observe('test_seconds', seconds, station = self.url, test = name)
+        if self.step_times.get('program_flash'):
+            m.observe('flash_mbytes_per_second', flash_bytes() / 1e6 / self.step_times['program_flash'], station = self.url)
+        m.observe('jtag_round_trips', self.testsuite.dut.stats['round_trips'], station = self.url)
+
+    def update_voltages(self):
+        self.ui.set_stat('Supply', self.testsuite.voltages[0])
+        self.ui.set_stat('Vaux', self.testsuite.voltages[1])
+        self.ui.set_stat('+5.0V', self.testsuite.voltages[2])
+        self.ui.set_stat('+3.3V', self.testsuite.voltages[3])
+        self.ui.set_stat('+1.8V', self.testsuite.voltages[4])
+        self.ui.set_stat('+1.0V', self.testsuite.voltages[5])
+        self.ui.set_stat('Vusb', self.testsuite.voltages[6])
+
+    def update_unique_id(self):
+        fpga_id_string = f'{self.testsuite.unique:016X}'
+        self.ui.set_stat('FPGA ID', fpga_id_string)
+        self.check_resume(fpga_id_string)
+        self.checkpoint.dna = fpga_id_string
+        if not self.database:
+            self.write("No database; serial number and FPGA ID are not checked against previous boards.\n")
+            return
+        try:
+            db = self.database()
+            serial_from_id = db.get_serial(fpga_id_string)
+            board = db.get_board(self.serial)
+        except Exception as e:
+            self.ui.show_error("Database", str(e))
+            raise TestFailCritical(str(e))
+        if serial_from_id:
+            if serial_from_id != self.serial:
+                msg = f"FPGA ID {fpga_id_string} was previously associated with Serial Number {serial_from_id}!"
+                self.ui.show_error("Wrong FPGA ID", msg)
+                raise TestFailCritical(msg)
+
+        if board:
+            if 'fpga_id' in board:
+                if board['fpga_id'] != fpga_id_string:
+                    msg = f"Serial Number {self.serial} has already been used for a board with FPGA ID {board['fpga_id']}!"
+                    self.ui.show_error("Wrong Serial #", msg)
+                    raise TestFailCritical(msg)
+
+    def check_resume(self, fpga_id_string):
+        """Continues from the checkpoint only when it was made for this very board."""
+        if not self.resume:
+            return
+        if self.resume.dna != fpga_id_string:
+            self.write("This is not the board of the previous run; running all tests.\n\n")
+            self.resume = None
+            return
+        self.checkpoint = self.resume
+        self.testsuite.set_values(self.resume.values)
+        if self.testsuite.voltages_mv:
+            self.update_voltages()
+        if self.testsuite.flashid:
+            self.ui.set_stat('Board Revision', f'{self.testsuite.revision}')
+            self.ui.set_stat('Flash ID', f'{self.testsuite.flashid:016X}')
+
+    def update_board_revision(self):
+        self.ui.set_stat('Board Revision', f'{self.testsuite.revision}')
+        self.ui.set_stat('Flash ID', f'{self.testsuite.flashid:016X}')
+        if self.testsuite.revision == 16:
+            self.testsuite.proto = True
+            self.errors -= 1
+            # Rerun test!
+            self.run_one_test('test_001_regulators')
+
+    def report_rails(self):
+        for (rail, v) in self.testsuite.telemetry.violations().items():
+            self.write(f"Warning: rail {rail} out of limits in {v['below'] + v['above']} samples "
+                       f"(min {v['min']} mV, max {v['max']} mV)\n")
+
+    def save_log(self):
+        self.logfile.write(''.join(self.log_text))
+
+    def write_run_record(self):
+        record = {
+            'serial': self.serial,
+            'date': datetime.now().isoformat(timespec = 'seconds'),
+            'git': self.gitsha,
+            'cable': self.url,
+            'fpga_id': f'{self.testsuite.unique:016X}',
+            'flash_id': f'{self.testsuite.flashid:016X}',
+            'board_rev': self.testsuite.revision,
+            'voltages_mv': self.testsuite.voltages_mv,
+            'tests': self.results,
+            'errors': self.errors,
+            'critical': self.critical,
+            'flashed': self.flashed,
+            'booted': self.boot_ok,
+            'elapsed': round(self.end_time - self.start_time, 3),
+            'images': image_hashes(),
+            'jtag': dict(self.testsuite.dut.stats),
+            'critical_path': [ s.name for s in self.plan.critical_path()[1] ],
+            'telemetry': self.testsuite.telemetry.report(),
+            'plan': self.config.name,
+            'over_budget': self.config.over_budget(self.times()),
+        }
+        with self.lock:
+            self.records.write(record)
+
+    def write_test_to_db(self):
+        db = self.database()
+        time = datetime.now().strftime("%Y-%m-%d, %H:%M:%S")
+        if self.metrics:
+            self.metrics.inc('queue_depth', 1, queue = 'database')
+        with self.lock:
+            if self.metrics:
+                self.metrics.inc('queue_depth', -1, queue = 'database')
+            # Write board to board table
+            if self.testsuite.unique != 0 and self.testsuite.flashid != 0:
+                db.add_board({
+                    'serial': self.serial,
+                    'fpga_id': f'{self.testsuite.unique:016X}',
+                    'flash_id': f'{self.testsuite.flashid:016X}',
+                    'board_rev': self.testsuite.revision,
+                })
+
+            # Write statistiscs to stats table
+            db.add_test_results({
+                'serial': self.serial,
+                'flash_id': f'{self.testsuite.flashid:016X}',
+                'fpga_id': f'{self.testsuite.unique:016X}',
+                'date': time,
+                'vbus': self.testsuite.voltages[0][:-2],
+                'vaux': self.testsuite.voltages[1][:-2],
+                'vusb': self.testsuite.voltages[6][:-2],
+                'v50': self.testsuite.voltages[2][:-2],
+                'v33': self.testsuite.voltages[3][:-2],
+                'v18': self.testsuite.voltages[4][:-2],
+                'v10': self.testsuite.voltages[5][:-2],
+                'git': self.gitsha,
+                'flashed': self.flashed,
+                'booted' : self.boot_ok,
+                'critical': self.critical,
+                'failed': ','.join(self.failed_tests),
+            })
+
+            LogStore(db).upload(self.serial, time, ''.join(self.log_text))
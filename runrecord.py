@@ -0,0 +1,43 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+class RunRecordWriter:
+    """Appends one JSON object per board run to a JSON lines file."""
+    def __init__(self, filename = 'logs/runs.jsonl'):
+        self.filename = filename
+
+    def write(self, record):
+        line = json.dumps(record, separators = (',', ':'), default = str) + "\n"
+        # One write call per record, so a crash can at most lose the record being written
+        with open(self.filename, "a", encoding = 'utf-8') as f:
+            f.write(line)
+
+def load_records(filename = 'logs/runs.jsonl', serial = None):
+    """Yields the run records from a JSON lines file, optionally only those of one serial number."""
+    loads = orjson.loads if orjson else json.loads
+    needle = json.dumps(serial).encode('utf-8') if serial else None
+    with open(filename, "rb", buffering = 1024 * 1024) as f:
+        for line in f:
+            # Cheap byte test first; only lines that can match are parsed
+            if needle and needle not in line:
+                continue
+            if not line.strip():
+                continue
+            record = loads(line)
+            if serial and record.get('serial') != serial:
+                continue
+            yield record
+
+if __name__ == '__main__':
+    import sys
+    import time
+    start = time.perf_counter()
+    count = 0
+    for filename in sys.argv[1:]:
+        for record in load_records(filename):
+            count += 1
+    print(f"{count} records in {time.perf_counter() - start:.2f} sec.")
@@ -0,0 +1,151 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Resources a step can claim
+DUT = 'dut'         # talks to the board over JTAG; DUT steps run one at a time, in plan order
+HOST = 'host'       # only uses the tester PC
+NETWORK = 'network' # needs the database / internet
+
+def step(needs = (), resources = (DUT, ), setup = False):
+    """Declares the steps a test step depends on, and the resources it uses. Setup steps bring the DUT in the
+    state that later steps rely on, so they are never skipped when a run is resumed."""
+    def wrap(func):
+        func.needs = tuple(needs)
+        func.resources = tuple(resources)
+        func.setup = setup
+        return func
+    return wrap
+
+class Step:
+    def __init__(self, name, func, needs = (), resources = (DUT, )):
+        self.name = name
+        self.func = func
+        self.needs = tuple(needs)
+        self.resources = tuple(resources)
+        self.start = None
+        self.end = None
+        self.done = threading.Event()
+
+    @property
+    def on_dut(self):
+        return DUT in self.resources
+
+    @property
+    def duration(self):
+        if self.start is None or self.end is None:
+            return 0.0
+        return self.end - self.start
+
+class TestPlan:
+    """Runs DUT steps one by one on the calling thread, while host-only and network steps run on a thread
+    pool as soon as the steps they need are done."""
+    def __init__(self, steps, workers = 4):
+        self.steps = { s.name: s for s in steps }
+        self.workers = workers
+        for s in steps:
+            for need in s.needs:
+                if need not in self.steps:
+                    raise ValueError(f"Step {s.name} needs unknown step {need}")
+        self.order = self.sort()
+        self.started = None
+        self.finished = None
+
+    @staticmethod
+    def from_object(obj, prefixes):
+        """Collects the methods of obj whose name starts with one of the prefixes, in definition order."""
+        steps = [ ]
+        for name, func in obj.__class__.__dict__.items():
+            if callable(func) and name.startswith(tuple(prefixes)):
+                steps.append(Step(name, getattr(obj, name), getattr(func, 'needs', ()), getattr(func, 'resources', (DUT, ))))
+        return TestPlan(steps)
+
+    def sort(self):
+        """Topological order, stable with respect to the definition order."""
+        order = [ ]
+        placed = set()
+        pending = list(self.steps.values())
+        while pending:
+            for s in pending:
+                if all(n in placed for n in s.needs):
+                    break
+            else:
+                raise ValueError("Circular step dependencies: " + ', '.join(s.name for s in pending))
+            pending.remove(s)
+            order.append(s)
+            placed.add(s.name)
+        return order
+
+    def run(self, run_dut, run_host = None):
+        """Executes the plan. run_dut(step) runs one DUT step and returns True to abort the remaining DUT steps.
+        run_host(step) runs one host step on a pool thread; by default it calls the step function."""
+        if not run_host:
+            run_host = lambda s: s.func()
+
+        def host(s):
+            for n in s.needs:
+                self.steps[n].done.wait()
+            s.start = time.perf_counter()
+            try:
+                run_host(s)
+            finally:
+                s.end = time.perf_counter()
+                s.done.set()
+
+        self.started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers = self.workers) as pool:
+            futures = [ pool.submit(host, s) for s in self.order if not s.on_dut ]
+            aborted = False
+            for s in self.order:
+                if not s.on_dut:
+                    continue
+                for n in s.needs:
+                    self.steps[n].done.wait()
+                if aborted:
+                    s.done.set()
+                    continue
+                s.start = time.perf_counter()
+                try:
+                    aborted = run_dut(s)
+                finally:
+                    s.end = time.perf_counter()
+                    s.done.set()
+            for f in futures:
+                f.result()
+        self.finished = time.perf_counter()
+        return not aborted
+
+    def critical_path(self):
+        """Returns (total time, steps) of the longest chain of steps that had to wait on each other.
+        Consecutive DUT steps count as dependent, since they share the board."""
+        finish = { }
+        via = { }
+        previous_dut = None
+        for s in self.order:
+            preds = list(s.needs)
+            if s.on_dut:
+                if previous_dut:
+                    preds.append(previous_dut)
+                previous_dut = s.name
+            best = max(preds, key = lambda n: finish[n], default = None)
+            finish[s.name] = s.duration + (finish[best] if best else 0.0)
+            via[s.name] = best
+        if not finish:
+            return (0.0, [ ])
+        name = max(finish, key = lambda n: finish[n])
+        total = finish[name]
+        path = [ ]
+        while name:
+            path.insert(0, self.steps[name])
+            name = via[name]
+        return (total, path)
+
+    def report(self):
+        (total, path) = self.critical_path()
+        lines = [ f"Critical path: {total:.1f} sec. of {self.finished - self.started:.1f} sec. wall time" ]
+        for s in path:
+            lines.append(f"  {s.duration:6.2f}  {s.name}")
+        host = [ s for s in self.order if not s.on_dut and s not in path ]
+        if host:
+            lines.append("Overlapped: " + ', '.join(f"{s.name} ({s.duration:.2f})" for s in host))
+        return '\n'.join(lines) + '\n'
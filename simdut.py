@@ -0,0 +1,313 @@
+import time
+import zlib
+import random
+import struct
+import logging
+from jtag_xilinx import JtagClient, JtagClientException, MAILBOX_START, MAILBOX_END, IR_LENGTH, CFG_IN_DELAY
+from jtag_xilinx import XILINX_IDCODE, XILINX_FUSE_DNA, XILINX_USER4, XILINX_PROGRAM, XILINX_CFG_IN, XILINX_START
+from jtaglock import atomic
+from registers import PROG_PROGRESS, PROG_LENGTH, TESTER_PARAM, TESTER_TO_DUT, TEST_STATUS, VOLTAGES, SERIAL_NUMBER
+from tests import DUT_USER_ID, TEST_SET_SERIAL, TEST_GET_SERIAL, dut_fpga
+
+logger = logging.getLogger('JTAG')
+
+IDCODE = 0x0362C093
+PAGE = 0x10000
+SYNC_BITS = '10101010100110010101010101100110' # 0xAA995566, as it is shifted in
+
+def lsb_bits(value, length):
+    """value as a string of '0' and '1', in shift order: the least significant bit first."""
+    return format(value, f'0{length}b')[::-1]
+
+def stream_bits(data):
+    """Bytes as shifted MSB first, as a string of '0' and '1'."""
+    return format(int.from_bytes(data, 'big'), f'0{8 * len(data)}b') if data else ''
+
+class SparseMemory:
+    """DUT memory that only takes room for the pages that were written."""
+    def __init__(self):
+        self.pages = { }
+
+    def clear(self):
+        self.pages = { }
+
+    def write(self, addr, data):
+        offset = 0
+        while offset < len(data):
+            (page, start) = divmod(addr + offset, PAGE)
+            now = min(PAGE - start, len(data) - offset)
+            buffer = self.pages.setdefault(page, bytearray(PAGE))
+            buffer[start:start + now] = data[offset:offset + now]
+            offset += now
+
+    def read(self, addr, length):
+        result = bytearray()
+        while length > 0:
+            (page, start) = divmod(addr, PAGE)
+            now = min(PAGE - start, length)
+            buffer = self.pages.get(page)
+            result += buffer[start:start + now] if buffer else bytes(now)
+            addr += now
+            length -= now
+        return bytes(result)
+
+class SimulatedDut(JtagClient):
+    """Stands in for a board on a cable, for soak runs and tests of the tester itself. It models what the
+    tester sees of the DUT: IDCODE and DNA, the tester FPGA image, memory, the bootloader, the test application
+    and its mailbox. The mailbox handshake, uploads and flashing go through the JtagClient code unchanged.
+    Commands complete after test_time seconds, with the given result. With fault, the commands print that line
+    instead, and hang. Every transaction takes round_trip seconds, as USB would."""
+    def __init__(self, url = 'sim://0', test_time = 0.0, result = 0, revision = 17, fault = None, round_trip = 0.0):
+        self.url = url
+        self.init_state()
+        self.test_time = test_time
+        self.result = result
+        self.revision = revision
+        self.fault = fault
+        self.round_trip = round_trip
+        self.settle_scale = 0.0 # The simulated hardware is ready at once
+        self.selected = None
+        seed = zlib.crc32(url.encode())
+        self.dna = 0x0040000000000000 | seed
+        self.flash_id = struct.pack(">Q", 0xEF40180000000000 | seed)
+        self.noise = random.Random(seed)
+        self.memory = SparseMemory()
+        self.fpga_loaded = False
+        self.running = False # The CPU is out of reset
+        self.app = False # The test application runs, and serves the mailbox
+        self.command = 0
+        self.done_at = 0
+        self.console = [ ]
+        self.flash_index = 0
+        self.serial = ''
+
+    def reset_stats(self):
+        JtagClient.reset_stats(self)
+        self.stats['interleaved'] = 0
+
+    def count(self, written = 0, read = 0):
+        # A transaction selects a register and then shifts; another thread using the cable in between shows here
+        token = object()
+        self.selected = token
+        if self.round_trip:
+            time.sleep(self.round_trip)
+        if self.selected is not token:
+            self.stats['interleaved'] += 1
+        self.stats['round_trips'] += 1
+        self.stats['bytes_written'] += written
+        self.stats['bytes_read'] += read
+
+    @atomic
+    def resync(self):
+        self.mailbox.invalidate()
+        return IDCODE
+
+    @atomic
+    def xilinx_read_id(self):
+        self.count(read = 4)
+        return IDCODE
+
+    @atomic
+    def xilinx_read_dna(self):
+        self.count(read = 8)
+        return self.dna
+
+    @atomic
+    def xilinx_load_fpga(self, filename):
+        self.mailbox.invalidate()
+        with open(filename, "rb") as f:
+            self.count(written = len(f.read()))
+        self.fpga_loaded = True
+        self.running = False
+        self.app = False
+        self.memory.clear()
+
+    @atomic
+    def user_read_id(self):
+        self.count(read = 4)
+        return DUT_USER_ID if self.fpga_loaded else 0
+
+    @atomic
+    def user_set_outputs(self, value):
+        self.count(written = 1)
+        if not value & 0x80:
+            self.running = False
+            self.app = False
+            return
+        if self.running:
+            return
+        self.running = True
+        self.console.append("RAM OK!!\n")
+        (addr, magic) = struct.unpack("<LL", self.memory.read(0xFFF8, 8))
+        if magic == 0x1571babe:
+            self.memory.write(0xFFFC, bytes(4)) # The bootloader takes the magic only once
+            self.app = True
+            self.command = 0
+            self.console.append("DUT Main\n")
+
+    @atomic
+    def user_write_memory(self, addr, buffer):
+        self.count(written = len(buffer))
+        self.memory.write(addr, buffer)
+        if addr < MAILBOX_END and addr + len(buffer) > MAILBOX_START:
+            self.mailbox.forget(addr, len(buffer))
+        if self.app and addr <= TESTER_TO_DUT < addr + len(buffer):
+            self.start(struct.unpack("<L", self.memory.read(TESTER_TO_DUT, 4))[0])
+
+    @atomic
+    def user_read_memory(self, addr, len):
+        self.serve()
+        self.count(read = len)
+        return self.memory.read(addr, len)
+
+    @atomic
+    def user_write_io(self, addr, bytes):
+        self.count(written = len(bytes))
+        if addr == 0x60200 and bytes[:1] == b'\x4B':
+            self.flash_index = 0 # Read unique ID command to the flash
+
+    @atomic
+    def user_read_io(self, addr, len):
+        self.count(read = len)
+        if addr == 0x10000c:
+            return struct.pack("B", self.revision << 3)
+        data = self.flash_id[self.flash_index:self.flash_index + len]
+        self.flash_index = (self.flash_index + len) % 8
+        return data
+
+    @atomic
+    def user_read_console(self, do_print = False):
+        self.serve()
+        text = ''.join(self.console)
+        self.console = [ ]
+        self.count(read = max(1, len(text)))
+        if do_print:
+            for line in text.split("\n")[:-1]:
+                logger.info(line.strip())
+        return text
+
+    @atomic
+    def reboot(self, test_id):
+        self.mailbox.command(test_id)
+        self.mailbox.invalidate()
+        # The board starts from its flash, which holds the final images after programming
+        self.fpga_loaded = False
+        self.app = False
+        self.console.append("ConfigManager opened flash\n")
+        return self.user_read_console(True)
+
+    # The test application
+    def start(self, command):
+        if command and not self.command:
+            self.command = command
+            self.done_at = time.perf_counter() + self.test_time
+            if self.fault:
+                self.console.append(f"Test {command}: {self.fault}\n")
+                self.done_at = float('inf')
+
+    def serve(self):
+        """Measures the voltages, and completes the command when its time has come."""
+        if not self.app:
+            return
+        mv = [ 12000, 3300, 5000, 3300, 1800, 1000, 5000, 0 ]
+        mv = [ v + int(self.noise.gauss(0, v / 500)) if v else 0 for v in mv ]
+        self.memory.write(VOLTAGES, struct.pack("<8H", *mv))
+        if not self.command or time.perf_counter() < self.done_at:
+            return
+        command = self.command
+        if command in (50, 52): # Flashing; the progress is in pages
+            length = struct.unpack("<L", self.memory.read(PROG_LENGTH, 4))[0]
+            self.memory.write(PROG_PROGRESS, struct.pack("<L", (length + 255) // 256))
+        elif command == TEST_SET_SERIAL:
+            length = struct.unpack("<L", self.memory.read(TESTER_PARAM, 4))[0]
+            self.serial = self.memory.read(SERIAL_NUMBER, length).decode()
+            self.console.append(f"Serial number set to {self.serial}\n")
+        elif command == TEST_GET_SERIAL:
+            self.console.append(f"Serial number: {self.serial}\n")
+        self.console.append(f"Test {command} done.\n")
+        self.memory.write(TEST_STATUS, struct.pack("<L", self.result))
+        self.memory.write(TESTER_TO_DUT, struct.pack("<L", 0))
+        self.command = 0
+
+class ChainDevice:
+    """One FPGA of a simulated chain, as far as its TAP goes: instruction, data registers and configuration."""
+    def __init__(self, dna):
+        self.dna = dna
+        self.ir = XILINX_IDCODE
+        self.user_ir = 0
+        self.config = [ ] # Bits received in CFG_IN since the last JPROGRAM
+        self.configured = False
+
+    def register(self, capture, length, bits):
+        """A shift register that captured a value: that comes out first, then what was shifted in."""
+        return (lsb_bits(capture, length) + bits)[:len(bits)]
+
+    def shift(self, bits):
+        """Shifts the bits through the selected data register; returns what comes out at the TDO side."""
+        if self.ir == XILINX_IDCODE:
+            return self.register(IDCODE, 32, bits)
+        if self.ir == XILINX_FUSE_DNA:
+            return self.register(self.dna, 64, bits)
+        if self.ir == XILINX_CFG_IN:
+            self.config.append(bits)
+            return self.register(0, CFG_IN_DELAY, bits)
+        if self.ir == XILINX_USER4 and self.configured:
+            # A '1' first selects the user register, taken at Update-DR; a '0' first shifts the data of the register
+            if len(bits) >= 5 and bits[-5] == '1':
+                self.user_ir = int(bits[-4:][::-1], 2)
+                return '0' * len(bits)
+            return self.register((DUT_USER_ID if self.user_ir == 0 else 0) << 1, 33, bits)
+        return self.register(0, 1, bits) # BYPASS, and anything not modeled
+
+    def start(self, image_bits):
+        """JSTART: configured when the image arrived whole, after a sync word at any bit offset."""
+        received = ''.join(self.config)
+        at = received.find(SYNC_BITS)
+        self.configured = at >= 0 and received[at:at + len(image_bits)] == image_bits
+        self.user_ir = 0
+
+class SimulatedChain(JtagClient):
+    """Several boards with their FPGA on one JTAG chain, modeled bit by bit at the TAP. Position 0 is nearest
+    to TDO. Only the chain operations of JtagClient work on it; a device counts as configured when it received
+    the image, which then runs the tester FPGA image."""
+    def __init__(self, devices = 4, url = 'sim://chain', image = dut_fpga):
+        self.url = url
+        self.init_state()
+        self.devices = [ ChainDevice(0x0040000000000000 | zlib.crc32(f'{url}/{p}'.encode())) for p in range(devices) ]
+        with open(image, 'rb') as f:
+            bits = stream_bits(f.read())
+        self.image_bits = bits[bits.find(SYNC_BITS):]
+
+    def tap_reset(self):
+        for device in self.devices:
+            device.ir = XILINX_IDCODE
+
+    def tap_ir(self, value, length):
+        if length != IR_LENGTH * len(self.devices):
+            raise JtagClientException(f"Instruction of {length} bits on a chain of {len(self.devices)} devices")
+        for (p, device) in enumerate(self.devices):
+            device.ir = (value >> (IR_LENGTH * p)) & ((1 << IR_LENGTH) - 1)
+            if device.ir == XILINX_PROGRAM:
+                device.config = [ ]
+                device.configured = False
+
+    def shift(self, bits):
+        # TDI goes into the last device; the output of each goes into the one before it
+        for device in reversed(self.devices):
+            bits = device.shift(bits)
+        return bits
+
+    def tap_dr(self, value, length):
+        self.stats['round_trips'] += 1
+        return int(self.shift(lsb_bits(value, length))[::-1], 2)
+
+    def tap_stream(self, chunks):
+        data = b''.join(chunks)
+        self.stats['bytes_written'] += len(data)
+        self.shift(stream_bits(data))
+
+    @atomic
+    def jtag_clocks(self, clocks):
+        for device in self.devices:
+            if device.ir == XILINX_START:
+                device.start(self.image_bits)
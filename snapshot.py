@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+import os
+import sys
+import json
+import time
+import argparse
+
+# Dumps DUT memory to a file, and compares dumps with each other or with the binary that was uploaded.
+# A snapshot is a raw file with a small .json next to it that holds the address it was taken from.
+
+CHUNK = 64 * 1024 # Bytes per read; keeps the progress display going without slowing down the bulk reads
+
+def progress(done, total, start):
+    rate = done / max(time.perf_counter() - start, 1e-6) / 1024
+    sys.stderr.write(f"\r{done // 1024:8d} / {total // 1024} KB  {100 * done / total:5.1f}%  {rate:7.1f} KB/s")
+    if done == total:
+        sys.stderr.write("\n")
+    sys.stderr.flush()
+
+def take_snapshot(dut, addr, length, filename, show = progress):
+    """Reads length bytes from addr into filename, through a memory map, so any size fits."""
+    import numpy as np
+    length = (length + 3) & ~3 # Memory reads are in whole words
+    data = np.memmap(filename, dtype = np.uint8, mode = 'w+', shape = (length, ))
+    start = time.perf_counter()
+    done = 0
+    while done < length:
+        now = min(CHUNK, length - done)
+        data[done:done + now] = np.frombuffer(dut.user_read_memory(addr + done, now), dtype = np.uint8)
+        done += now
+        if show:
+            show(done, length, start)
+    data.flush()
+    del data
+    with open(filename + '.json', 'w') as f:
+        json.dump({ 'address': addr, 'length': length, 'date': time.strftime('%Y-%m-%d %H:%M:%S') }, f)
+    return length
+
+def load(filename, base = None):
+    """Returns (address, data) of a snapshot, or of a binary image at address base."""
+    import numpy as np
+    if base is None:
+        try:
+            with open(filename + '.json') as f:
+                base = json.load(f)['address']
+        except FileNotFoundError:
+            base = 0
+    if os.path.getsize(filename) == 0:
+        return (base, np.zeros(0, dtype = np.uint8))
+    return (base, np.memmap(filename, dtype = np.uint8, mode = 'r'))
+
+def changed_ranges(a_base, a, b_base, b, block = 256):
+    """Compares the overlapping part of a and b in aligned blocks. Returns a list of (first, end, bytes)
+    per range of consecutive changed blocks: addresses, and the number of bytes that differ."""
+    import numpy as np
+    start = max(a_base, b_base)
+    end = min(a_base + len(a), b_base + len(b))
+    if end <= start:
+        return [ ]
+    # Blocks are aligned to the address, so the ranges are the same whichever way the files are cut.
+    # The comparison goes in slabs, to keep memory use flat for snapshots of the whole DDR2.
+    first = start - start % block
+    blocks = (end - first + block - 1) // block
+    differ = np.zeros(blocks, dtype = np.int64)
+    slab = max(1, (4 * 1024 * 1024) // block)
+    for i in range(0, blocks, slab):
+        n = min(slab, blocks - i)
+        lo = max(first + i * block, start)
+        hi = min(first + (i + n) * block, end)
+        padded = np.zeros(n * block, dtype = bool)
+        offset = lo - (first + i * block)
+        padded[offset:offset + hi - lo] = a[lo - a_base:hi - a_base] != b[lo - b_base:hi - b_base]
+        differ[i:i + n] = padded.reshape(n, block).sum(axis = 1)
+    changed = np.flatnonzero(differ)
+    if not len(changed):
+        return [ ]
+    # Split where the changed block numbers are not consecutive
+    breaks = np.flatnonzero(np.diff(changed) > 1) + 1
+    ranges = [ ]
+    for run in np.split(changed, breaks):
+        lo = max(first + int(run[0]) * block, start)
+        hi = min(first + (int(run[-1]) + 1) * block, end)
+        ranges.append((lo, hi, int(differ[run].sum())))
+    return ranges
+
+def report(ranges, out = sys.stdout):
+    if not ranges:
+        out.write("No differences.\n")
+        return
+    for (lo, hi, count) in ranges:
+        out.write(f"{lo:08X}-{hi - 1:08X}  {hi - lo:8d} bytes, {count:8d} differ\n")
+    out.write(f"{len(ranges)} changed ranges, {sum(c for (_, _, c) in ranges)} bytes differ.\n")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'DUT memory snapshots.')
+    commands = parser.add_subparsers(dest = 'command', required = True)
+    dump = commands.add_parser('dump', help = 'read DUT memory into a file')
+    dump.add_argument('address', type = lambda s: int(s, 0))
+    dump.add_argument('length', type = lambda s: int(s, 0))
+    dump.add_argument('file')
+    dump.add_argument('--url', default = 'ftdi://ftdi:232h/0')
+    diff = commands.add_parser('diff', help = 'compare two snapshots, or a snapshot and a binary image')
+    diff.add_argument('a')
+    diff.add_argument('b')
+    diff.add_argument('--base', type = lambda s: int(s, 0), help = 'address of b, when it is a binary image, e.g. 0x30000')
+    diff.add_argument('--block', type = lambda s: int(s, 0), default = 256)
+    args = parser.parse_args()
+
+    if args.command == 'dump':
+        from jtag_xilinx import JtagClient
+        from tests import DUT_USER_ID
+        dut = JtagClient(args.url)
+        if dut.user_read_id() != DUT_USER_ID:
+            print("Warning: the DUT does not run the tester FPGA image; memory may not be readable.", file = sys.stderr)
+        take_snapshot(dut, args.address, args.length, args.file)
+    else:
+        (a_base, a) = load(args.a)
+        (b_base, b) = load(args.b, args.base)
+        report(changed_ranges(a_base, a, b_base, b, args.block))
@@ -0,0 +1,162 @@
+#!/usr/bin/python3
+import os
+import sys
+import gc
+import time
+import logging
+import argparse
+import tempfile
+import threading
+import tracemalloc
+from runner import BoardRunner
+from planconfig import PlanConfig
+from runrecord import RunRecordWriter
+from tests import Ultimate64IITests
+from jtag_xilinx import JtagClient
+from batch import RunnerLogHandler
+
+# Endurance run: the full board flow, over and over, against a simulated DUT. Resource use is measured after
+# every board; anything that keeps growing over the run fails the soak, since on a real station it would
+# slow down or crash the tester late in a shift.
+
+# Growth over the measured part of the run (fitted line, first to last board) that fails the soak, on top of
+# the churn seen during the warm-up, e.g. of executor threads and the files they hold
+LIMITS = {
+    'rss_kb': 16 * 1024,
+    'traced_kb': 2 * 1024,
+    'handles': 2,
+    'threads': 1,
+    'handlers': 0,
+    'latency_ms': None, # Relative; see LATENCY_GROWTH
+}
+LATENCY_GROWTH = 0.2 # Fraction of the mean board time
+
+def rss_kb():
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss // 1024
+    except ImportError:
+        pass
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+def handles():
+    """Open files and sockets; handles on Windows."""
+    try:
+        import psutil
+        p = psutil.Process()
+        return p.num_handles() if os.name == 'nt' else p.num_fds()
+    except ImportError:
+        return len(os.listdir('/proc/self/fd'))
+
+class QuietUI:
+    """The soak has no window; errors are counted, not shown."""
+    def __init__(self):
+        self.errors = [ ]
+
+    def write(self, text):
+        pass
+
+    def set_icon(self, name, passed):
+        pass
+
+    def set_stat(self, name, value):
+        pass
+
+    def set_progress(self, index, value):
+        pass
+
+    def show_error(self, title, msg):
+        self.errors.append(f'{title}: {msg}')
+
+def trend(values):
+    """Slope of the least squares line through the values, times the length of the run: the growth."""
+    n = len(values)
+    if n < 2:
+        return 0.0
+    mean_x = (n - 1) / 2
+    mean_y = sum(values) / n
+    sxx = sum((x - mean_x) ** 2 for x in range(n))
+    sxy = sum((x - mean_x) * (y - mean_y) for (x, y) in enumerate(values))
+    return sxy / sxx * (n - 1)
+
+class Soak:
+    def __init__(self, boards, url = 'sim://soak', warmup = None, config = None):
+        self.boards = boards
+        self.config = config
+        self.url = url
+        self.warmup = warmup if warmup is not None else max(5, boards // 10) # Caches fill up in the first boards
+        self.samples = [ ]
+        self.failures = 0
+
+    def sample(self, elapsed):
+        gc.collect()
+        (traced, _) = tracemalloc.get_traced_memory()
+        self.samples.append({
+            'rss_kb': rss_kb(),
+            'traced_kb': traced // 1024,
+            'handles': handles(),
+            'threads': threading.active_count(),
+            'handlers': len(logging.getLogger('Tests').handlers) + len(logging.getLogger('JTAG').handlers),
+            'latency_ms': 1000 * elapsed,
+        })
+
+    def run(self):
+        tracemalloc.start()
+        with tempfile.TemporaryDirectory() as directory:
+            ui = QuietUI()
+            records = RunRecordWriter(os.path.join(directory, 'runs.jsonl'))
+            runner = BoardRunner(ui, None, self.url, records, directory = directory, config = self.config)
+            handler = RunnerLogHandler(runner.write)
+            for i in range(self.boards):
+                # As the GUI does for every board
+                Ultimate64IITests.add_log_handler(handler)
+                JtagClient.add_log_handler(handler)
+                start = time.perf_counter()
+                summary = runner.run(f'SOAK{i:06d}')
+                if not summary or not summary['passed']:
+                    self.failures += 1
+                self.sample(time.perf_counter() - start)
+                if (i + 1) % 100 == 0:
+                    s = self.samples[-1]
+                    print(f"{i + 1:6d} boards: RSS {s['rss_kb']} KB, traced {s['traced_kb']} KB, "
+                          f"{s['handles']} handles, {s['latency_ms']:.0f} ms/board", file = sys.stderr)
+        tracemalloc.stop()
+        return self.check()
+
+    def churn(self, name):
+        """How much a measure goes up and down from board to board without growing: its range during the warm-up,
+        leaving out the first board, which loads and caches everything."""
+        values = [ s[name] for s in self.samples[1:self.warmup] ]
+        return max(values) - min(values) if values else 0
+
+    def check(self):
+        """Prints the growth of every measure; returns False when one grew beyond its limit."""
+        measured = self.samples[self.warmup:]
+        ok = self.failures == 0
+        print(f"{len(self.samples)} boards, {self.failures} failed; growth over the last {len(measured)}:")
+        for (name, limit) in LIMITS.items():
+            values = [ s[name] for s in measured ]
+            if not values:
+                continue
+            growth = trend(values)
+            if limit is None:
+                limit = LATENCY_GROWTH * sum(values) / len(values)
+            limit += self.churn(name)
+            verdict = 'ok' if growth <= limit else 'GROWING'
+            ok = ok and growth <= limit
+            print(f"  {name:12s} {values[0]:10.1f} -> {values[-1]:10.1f}  growth {growth:10.1f} (limit {limit:.1f})  {verdict}")
+        return ok
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Runs the full test flow many times on a simulated DUT, and fails on growing resource use.')
+    parser.add_argument('boards', type = int, nargs = '?', default = 1000)
+    parser.add_argument('--url', default = 'sim://soak', help = 'cable to use; a sim:// URL for the simulated DUT')
+    parser.add_argument('--warmup', type = int, help = 'boards to leave out of the trends (default: 10%%)')
+    parser.add_argument('--plan', help = 'test plan file (default: all tests)')
+    args = parser.parse_args()
+    soak = Soak(args.boards, args.url, args.warmup, PlanConfig.load(args.plan) if args.plan else None)
+    exit(0 if soak.run() else 1)
@@ -0,0 +1,72 @@
+class Telemetry:
+    """Rail voltages in millivolts, sampled during the run into a fixed size ring buffer. Samples are taken
+    from the status polls the tester does anyway; the run is divided in phases, usually one per test step."""
+    def __init__(self, rails, limits = None, size = 4096):
+        import numpy as np
+        limits = limits or { }
+        self.np = np
+        self.rails = list(rails)
+        self.size = size
+        self.samples = np.zeros((size, len(self.rails)), dtype = np.uint16)
+        # Rails without limits are never out of range
+        self.low = np.array([ limits.get(rail, (0, 0xFFFF))[0] for rail in self.rails ])
+        self.high = np.array([ limits.get(rail, (0, 0xFFFF))[1] for rail in self.rails ])
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.phases = [ ] # (name, index of the first sample)
+
+    def phase(self, name):
+        self.phases.append((name, self.count))
+
+    def add(self, mv):
+        if not any(mv): # The DUT did not measure yet
+            return
+        self.samples[self.count % self.size] = mv
+        self.count += 1
+
+    def window(self, first, last):
+        """The samples first..last (exclusive), as far as they are still in the buffer."""
+        first = max(first, self.count - self.size)
+        if first >= last:
+            return self.samples[0:0]
+        return self.samples[self.np.arange(first, last) % self.size]
+
+    def phase_stats(self):
+        """Minimum, maximum and mean per rail, for each phase that has samples."""
+        result = [ ]
+        bounds = [ first for (_, first) in self.phases[1:] ] + [ self.count ]
+        for ((name, first), last) in zip(self.phases, bounds):
+            s = self.window(first, last)
+            if not len(s):
+                continue
+            result.append({
+                'phase': name,
+                'samples': len(s),
+                'min': dict(zip(self.rails, s.min(axis = 0).tolist())),
+                'max': dict(zip(self.rails, s.max(axis = 0).tolist())),
+                'mean': dict(zip(self.rails, s.mean(axis = 0).round(1).tolist())),
+            })
+        return result
+
+    def violations(self):
+        """Per rail that left its limits: the number of samples below and above, and the extremes."""
+        s = self.window(0, self.count)
+        if not len(s):
+            return { }
+        below = (s < self.low).sum(axis = 0)
+        above = (s > self.high).sum(axis = 0)
+        lowest = s.min(axis = 0)
+        highest = s.max(axis = 0)
+        result = { }
+        for i in self.np.flatnonzero(below + above):
+            result[self.rails[i]] = { 'below': int(below[i]), 'above': int(above[i]),
+                                      'min': int(lowest[i]), 'max': int(highest[i]) }
+        return result
+
+    def report(self):
+        return {
+            'phases': self.phase_stats(),
+            'violations': self.violations(),
+        }
@@ -1,17 +1,39 @@
 
-from jtag_xilinx import JtagClientException, JtagClient
+from jtag_xilinx import JtagClientException, DutTimeoutException, JtagClient
 import time
 import struct
-import numpy as np
+import functools
+import hashlib
+import os
 import logging
-from tkinter import ttk, messagebox
+from scheduler import step, TestPlan, DUT, HOST
+from telemetry import Telemetry
+from planconfig import PlanConfig
+from consolescan import ConsoleScanner, FATAL, PASS
 
 class TestFail(Exception):
-    pass
+    def __init__(self, message = '', line = None):
+        super().__init__(message)
+        self.line = line # The console line of the DUT that gave the failure away, if any
 
 class TestFailCritical(TestFail):
     pass
 
+class TestTimeout(TestFailCritical):
+    """The DUT did not complete a test; it is still busy with it, so no other test can run."""
+    pass
+
+def dut_timeout(method):
+    """For steps that wait for the DUT outside of perform_test(): a command that does not complete in time is a
+    TestTimeout, like in perform_test()."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        except DutTimeoutException as e:
+            raise TestTimeout(str(e))
+    return wrapper
+
 # create logger
 logger = logging.getLogger('Tests')
 logger.setLevel(logging.DEBUG)
@@ -52,13 +74,62 @@ TEST_WIFI_FLASH = 52
 
 TEST_ALL = 101
 
+DUT_USER_ID = 0xdead1541
+DUT_APPL_ADDR = 0x30000
+UPLOAD_BLOCK = 16384
+DDR_TEST_BYTES = 64 # Written at every address of the DDR2 memory test
+APPL_SAMPLES = 16 # Reads that tell whether the application is still in DUT memory on a warm retest
+SAMPLE_BYTES = 64
+
+VOLTAGE_NAMES = [ 'vbus', 'vaux', 'v50', 'v33', 'v18', 'v10', 'vusb' ]
+# Allowed range per rail in mV, +/- 5%; the supply and Vaux depend on the test setup and are not checked
+RAIL_LIMITS_MV = { 'v50': (4750, 5250), 'v33': (3135, 3465), 'v18': (1710, 1890), 'v10': (950, 1050), 'vusb': (4750, 5250) }
+
+# Console text of the test application that fails a test at once, or that shows a part of it went well.
+# A plan can add signatures, or drop one by setting it to null.
+# Only lines that mean the DUT crashed or hangs are fatal; a failing check is reported through the result
+CONSOLE_SIGNATURES = { 'FATAL': FATAL, 'Assertion failed': FATAL, 'PASSED': PASS, 'OK!': PASS }
+
+_image_hashes = { }
+
+def image_hashes():
+    """Returns the SHA-256 of every binary the tester loads or flashes; cached as long as the file does not change."""
+    result = { }
+    for name in [ dut_fpga, dut_appl, final_fpga, final_appl, final_fat, esp32_bootloader, esp32_partition_table, esp32_application ]:
+        stat = os.stat(name)
+        key = (name, stat.st_mtime, stat.st_size)
+        if key not in _image_hashes:
+            with open(name, "rb") as f:
+                _image_hashes[key] = hashlib.sha256(f.read()).hexdigest()
+        result[os.path.basename(name)] = _image_hashes[key]
+    return result
+
+def flash_bytes():
+    """Size of the images that program_flash writes."""
+    return sum(os.path.getsize(name) for name in [ final_fpga, final_appl, final_fat ])
 
-class Ultimate64IITests:
-    def __init__(self):
-        pass
 
-    def startup(self):
-        self.dut = JtagClient()    
+def ddr_test_addresses(depth = 26):
+    return [ 1 << i for i in range(6, depth) ]
+
+class Ultimate64IITests:
+    def __init__(self, config = None):
+        self.config = config or PlanConfig()
+        # What the tester last loaded into the DUT, to skip reloading it on a retest of the same board
+        self.session = { }
+        self.warm_start = True
+        self.telemetry = None
+        signatures = dict(CONSOLE_SIGNATURES, **self.config.signatures)
+        self.scanner = ConsoleScanner({ text: kind for (text, kind) in signatures.items() if kind })
+
+    def startup(self, url = 'ftdi://ftdi:232h/0'):
+        if url.startswith('sim://'):
+            from simdut import SimulatedDut
+            self.dut = SimulatedDut(url)
+        else:
+            self.dut = JtagClient(url)
+        self.telemetry = Telemetry(VOLTAGE_NAMES, RAIL_LIMITS_MV)
+        self.dut.telemetry = self.telemetry
         self.reset_variables()
 
     def reset_variables(self):
@@ -66,22 +137,74 @@ class Ultimate64IITests:
         self.flashid = 0
         self.unique = 0
         self.voltages = [ 'N/A', 'N/A', 'N/A', 'N/A', 'N/A', 'N/A', 'N/A', 'N/A' ]
+        self.voltages_mv = { }
         self.revision = 0
         self.serial = ""
         self.off = False
+        if self.telemetry:
+            self.telemetry.reset()
     
+    def timeout(self, name, default):
+        """The timeout of a test from the plan, in status polls of perform_test (five per second)."""
+        seconds = self.config.timeouts.get(name)
+        if seconds is None:
+            return default
+        return max(1, round(seconds * 5))
+
+    def perform_test(self, test_id, name, max_time, log = False, param = None):
+        """Runs a test in the DUT application, with the timeout of the plan for the named test method. The console
+        is scanned while waiting; a fatal signature fails the test with the line that holds it."""
+        self.scanner.reset()
+        try:
+            (result, text) = self.dut.perform_test(test_id, self.timeout(name, max_time), log, param, self.scanner)
+        except DutTimeoutException as e:
+            raise TestTimeout(str(e))
+        for (signature, kind, line) in self.scanner.matches:
+            logger.debug(f"Console {kind}: {line}")
+        if self.scanner.fatal:
+            (_, line) = self.scanner.fatal
+            if result is None:
+                # The DUT is still busy with the test and will not take the next one; stop here
+                raise TestFailCritical(f"DUT reported: {line}", line)
+            raise TestFail(f"DUT reported: {line} (Err = {result})", line)
+        return (result, text)
+
+    def get_values(self):
+        """Measured values, for the checkpoint."""
+        return { 'unique': self.unique, 'flashid': self.flashid, 'revision': self.revision, 'proto': self.proto,
+                 'voltages': self.voltages, 'voltages_mv': self.voltages_mv }
+
+    def set_values(self, values):
+        for (name, value) in values.items():
+            setattr(self, name, value)
+
     def read_voltages(self):
         rb = self.dut.user_read_memory(0x00A0, 16)
         (vbus, vaux, v50, v33, v18, v10, vusb) = struct.unpack("<HHHHHHH", rb[0:14])
+        self.voltages_mv = dict(zip(VOLTAGE_NAMES, (vbus, vaux, v50, v33, v18, v10, vusb)))
+        self.telemetry.add((vbus, vaux, v50, v33, v18, v10, vusb))
         self.voltages = [ f'{vbus/1000.0:.2f} V', f'{vaux/1000.0:.2f} V', f'{v50/1000.0:.2f} V', f'{v33/1000.0:.2f} V',
                           f'{v18/1000.0:.2f} V', f'{v10/1000.0:.2f} V', f'{vusb/1000.0:.2f} V' ]
 
+    @step(resources = (HOST, ))
+    def host_001_preload_images(self):
+        """Read the binaries into memory, while the DUT is busy"""
+        for name in [ dut_appl, final_fpga, final_appl, final_fat, esp32_bootloader, esp32_partition_table, esp32_application ]:
+            self.dut.preload_image(name)
+
+    @step(needs = ('host_001_preload_images', ), resources = (HOST, ))
+    def host_002_hash_images(self):
+        """Hash the binaries for the run record"""
+        image_hashes()
+
+    @step(setup = True)
     def test_001_unique_id(self):
         """Unique ID"""
         if self.dut.xilinx_read_id() != 0x0362C093:
             raise TestFailCritical("FPGA on DUT not recognized")
         self.unique = self.dut.xilinx_read_dna()
 
+    @step(setup = True)
     def test_002_test_fpga(self):
         """FPGA Detection & Load"""
         id = self.dut.xilinx_read_id()
@@ -89,9 +212,14 @@ class Ultimate64IITests:
             logger.error(f"IDCODE does not match: {id:08x}")
             raise TestFailCritical("FPGA on DUT not recognized")
         
-        self.dut.xilinx_load_fpga(dut_fpga)
-
-        if self.dut.user_read_id() != 0xdead1541:
+        if self.fpga_is_loaded():
+            logger.info("DUT still runs the tester FPGA image; skipping the FPGA load.")
+            self.dut.user_set_outputs(0x00) # Reset, such that the bootloader runs again
+        else:
+            self.dut.xilinx_load_fpga(dut_fpga)
+            self.session = { 'dna': self.unique, 'fpga': image_hashes()[os.path.basename(dut_fpga)] }
+
+        if self.dut.user_read_id() != DUT_USER_ID:
             raise TestFailCritical("DUT: User JTAG not working. (bad ID)")
 
         self.dut.user_set_outputs(0x80) # Unreset
@@ -113,42 +241,96 @@ class Ultimate64IITests:
     def test_004_ddr2_memory(self):
         """DDR2 Memory Test"""
         # bootloader should have run by now
-        time.sleep(0.5)
+        self.dut.settle(0.5)
         text = self.dut.user_read_console(True)
         if "RAM OK!!" not in text:
             raise TestFailCritical("Memory calibration failed.")
 
+        import numpy as np
         random = {} # Map of random byte blocks
-        for i in range(6,26):
-            random[i] = np.random.bytes(64)
+        addresses = ddr_test_addresses(self.config.ddr_depth)
+        for addr in addresses:
+            random[addr] = np.random.bytes(DDR_TEST_BYTES)
 
-        for i in range(6,26):
-            addr = 1 << i
+        for addr in addresses:
             logger.debug(f"Writing Addr: {addr:x}")
-            self.dut.user_write_memory(addr, random[i])
+            self.dut.user_write_memory(addr, random[addr])
 
-        for i in range(6,26):
-            addr = 1 << i
+        for addr in addresses:
             logger.debug(f"Reading Addr: {addr:x}")
-            rb = self.dut.user_read_memory(addr, 64)
-            if rb != random[i]:
-                logger.debug(random[i].hex())
+            rb = self.dut.user_read_memory(addr, DDR_TEST_BYTES)
+            if rb != random[addr]:
+                logger.debug(random[addr].hex())
                 logger.debug(rb.hex())
                 raise TestFailCritical('Verify error on DDR2 memory')
 
+    @step(setup = True)
     def test_005_start_app(self):
         """Run Application on DUT"""
-        self.dut.user_upload(dut_appl, 0x30000)
-        self.dut.user_run_app(0x30000)
-        time.sleep(0.5)
+        if self.appl_is_loaded():
+            logger.info("Test application still present in DUT memory; only restoring what the memory test overwrote.")
+            self.restore_appl()
+        else:
+            self.dut.user_upload(dut_appl, DUT_APPL_ADDR)
+            self.session['appl'] = self.appl_fingerprint(self.dut.read_image(dut_appl))
+        self.dut.user_run_app(DUT_APPL_ADDR)
+        self.dut.settle(0.5)
         text = self.dut.user_read_console(True)
         #logger.info(f"Console Output:\n{text}")
         if "DUT Main" not in text:
             raise TestFailCritical('Running test application failed')
 
+    def fpga_is_loaded(self):
+        """True when this very board still runs the FPGA image that the tester loaded last."""
+        if not self.warm_start or not self.session:
+            return False
+        if self.session.get('dna') != self.unique or self.session.get('fpga') != image_hashes()[os.path.basename(dut_fpga)]:
+            return False
+        return self.dut.user_read_id() == DUT_USER_ID
+
+    def appl_fingerprint(self, image):
+        return hashlib.sha1(image).hexdigest()
+
+    def appl_samples(self, length):
+        """Offsets of the words that are compared to tell whether DUT memory still holds the application: spread
+        over the whole image, leaving out the ranges that the DDR2 memory test overwrites."""
+        overwritten = [ (addr - DUT_APPL_ADDR, addr - DUT_APPL_ADDR + DDR_TEST_BYTES)
+                        for addr in ddr_test_addresses(self.config.ddr_depth) ]
+        offsets = [ ]
+        for i in range(APPL_SAMPLES):
+            offset = (i * max(0, length - SAMPLE_BYTES) // (APPL_SAMPLES - 1)) & ~3
+            if not any(start < offset + SAMPLE_BYTES and offset < end for (start, end) in overwritten):
+                offsets.append(offset)
+        return sorted(set(offsets))
+
+    def appl_is_loaded(self):
+        """True when the application uploaded last is the current image, and DUT memory still holds it: a few
+        short reads instead of reading back the whole image."""
+        if 'appl' not in self.session:
+            return False
+        image = self.dut.read_image(dut_appl)
+        if self.session['appl'] != self.appl_fingerprint(image):
+            return False
+        for offset in self.appl_samples(len(image)):
+            expected = image[offset:offset + SAMPLE_BYTES]
+            loaded = self.dut.user_read_memory(DUT_APPL_ADDR + offset, (len(expected) + 3) & ~3)
+            if loaded[:len(expected)] != expected:
+                return False
+        return True
+
+    def restore_appl(self):
+        """Rewrites the parts of the application that the DDR2 memory test has overwritten."""
+        # As user_upload() leaves it, with zeros after the image
+        padded = self.dut.read_image(dut_appl) + b'\x00' * 8
+        for addr in ddr_test_addresses(self.config.ddr_depth):
+            offset = addr - DUT_APPL_ADDR
+            if 0 <= offset < len(padded):
+                self.dut.user_write_memory(addr, padded[offset:offset + DDR_TEST_BYTES])
+
+    @dut_timeout
     def test_006_program_esp32(self):
         """Program ESP32"""
-        (result, _) = self.dut.perform_test(TEST_WIFI_DOWNLOAD)
+        (result, _) = self.perform_test(TEST_WIFI_DOWNLOAD, 'test_006_program_esp32', 10)
         if result != 0:
             raise TestFail(f"Err = {result}")
         self.dut.flash_callback[0:3] = [self.esp_callback, self.esp_callback, self.esp_callback]
@@ -164,10 +346,9 @@ class Ultimate64IITests:
 
     def test_007_all(self):
         """Run All Tests"""
-        #(result, _) = self.dut.perform_test(TEST_ALL, 50, True, 0xFBFB) # No speaker, no userport
-        #(result, _) = self.dut.perform_test(TEST_ALL, 50, True, 0xFBFF) # no speaker
-        (result, _) = self.dut.perform_test(TEST_ALL, 50, True, 0xFFFF) # ALL
-        #(result, _) = self.dut.perform_test(TEST_ALL, 50, True, 0x3000) # nothing except wifi
+        # The mask comes from the plan: 0xFFFF = all, 0xFBFF = no speaker, 0xFBFB = no speaker, no userport,
+        # 0x3000 = nothing except wifi
+        (result, _) = self.perform_test(TEST_ALL, 'test_007_all', 50, True, self.config.test_all_mask)
         if result != 0:
             raise TestFail(f"Err = {result}")
 
@@ -178,52 +359,53 @@ class Ultimate64IITests:
 
     def test_009_serial_number(self):
         """Set Serial Number"""
-        (result, _) = self.dut.perform_test(TEST_SET_SERIAL, 10, True, self.serial)
+        (result, _) = self.perform_test(TEST_SET_SERIAL, 'test_009_serial_number', 10, True, self.serial)
 
     def test_009a_get_serial(self):
         """Get Serial Number"""
-        (result, _) = self.dut.perform_test(TEST_GET_SERIAL, 10, True)
+        (result, _) = self.perform_test(TEST_GET_SERIAL, 'test_009a_get_serial', 10, True)
 
     def _test_010_clear_config(self):
         """Clear Config"""
-        (result, _) = self.dut.perform_test(TEST_CLEAR_CONFIG, 10, True)
+        (result, _) = self.perform_test(TEST_CLEAR_CONFIG, '_test_010_clear_config', 10, True)
 
     def _test_008_ethernet(self):
         """Ethernet"""
-        (result, console) = self.dut.perform_test(TEST_ETHERNET)
+        (result, console) = self.perform_test(TEST_ETHERNET, '_test_008_ethernet', 10)
         logger.debug(f"Console Output:\n{console}")
         if result != 0:
             raise TestFail(f"Ethernet Test failed Err = {result}")
 
     def _test_009_usb_hub(self):
         """USB HUB Detection"""
-        (result, console) = self.dut.perform_test(TEST_USB_INIT)
+        (result, console) = self.perform_test(TEST_USB_INIT, None, 10)
         logger.debug(f"Console Output:\n{console}")
-        (result, console) = self.dut.perform_test(TEST_USB_HUB)
+        (result, console) = self.perform_test(TEST_USB_HUB, '_test_009_usb_hub', 10)
         logger.debug(f"Console Output:\n{console}")
         if result != 0:
             raise TestFail(f"Couldn't find USB HUB (USB2513) Err = {result}")
 
     def _test_021_iec(self):
         """IEC (Serial DIN)"""
-        (result, console) = self.dut.perform_test(TEST_IEC)
+        (result, console) = self.perform_test(TEST_IEC, '_test_021_iec', 10)
         logger.debug(f"Console Output:\n{console}")
         if result != 0:
             raise TestFail(f"IEC Serial Fault. Err = {result}")
 
     def _test_024_cassette_pins(self):
         """Cassette Pins"""
-        (result, console) = self.dut.perform_test(TEST_CASSETTE)
+        (result, console) = self.perform_test(TEST_CASSETTE, '_test_024_cassette_pins', 10)
         logger.debug(f"Console Output:\n{console}")
         if result != 0:
             raise TestFail(f"Cassette I/O fault. Err = {result}")
 
     def _test_025_clear_flash(self):
         """Clear Flash"""
-        (result, _) = self.dut.perform_test(TEST_CLEAR_FLASH, 20, True)
+        (result, _) = self.perform_test(TEST_CLEAR_FLASH, '_test_025_clear_flash', 20, True)
         if result != 0:
             raise TestFail(f"Flash clear failed")
         
+    @dut_timeout
     def program_flash(self, cb = [None, None, None]):
         """Program Flash!"""
         # Program the flash in three steps: 1) FPGA, 2) Application, 3) FAT Filesystem
@@ -241,6 +423,7 @@ class Ultimate64IITests:
     def late_099_boot(self):
         """Boot Test"""
         logger.info("Rebooting DUT")
+        self.session = { } # The DUT boots its own FPGA image from flash
         console = self.dut.reboot(TEST_REBOOT)
         return "onfigManager opened flash" in console
 
@@ -259,12 +442,19 @@ class Ultimate64IITests:
         for test in all:
             try:
                 test()
+            except TestTimeout as e:
+                logger.critical(f"Test did not complete: {e}")
+                return
             except TestFail as e:
                 logger.error(f"Test failed: {e}")
             except JtagClientException as e:
                 logger.critical(f"JTAG Communication error: {e}")
                 return
 
+    def get_plan(self):
+        """Returns the test steps and the host-side steps that can overlap with them."""
+        return TestPlan.from_object(self, [ "test", "host" ] + self.config.optional)
+
     def get_all_tests(self):
         di = self.__class__.__dict__
         funcs = {}
@@ -273,15 +463,17 @@ class Ultimate64IITests:
                 funcs[k] = di[k]
             if k.startswith("late"):
                 funcs[k] = di[k]
+            if k in self.config.optional:
+                funcs[k] = di[k]
         return funcs
 
     @staticmethod
     def add_log_handler(ch):
         global logger
-        logger.addHandler(ch)
+        if ch not in logger.handlers:
+            logger.addHandler(ch)
 
 
 if __name__ == '__main__':
     tests = Ultimate64IITests()
-    tests.startup()
     tests.run_all()